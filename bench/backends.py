@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Check that the lxml and ElementTree XML backends give byte-identical
+# output when joining the scores in test/, and compare how long they take.
+# Exits non-zero if any output differs, or if lxml isn't installed.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+join = os.path.join(here, "..", "mscore-python", "mscore-join.py")
+test = os.path.join(here, "..", "test")
+
+def cases():
+    # (name, mscore-join.py arguments)
+    movements = [os.path.join(test, "Mvt%d.mscx" % n) for n in (1, 2, 3)]
+    yield "join", movements
+    yield "join-line-breaks", ["-l"] + movements
+    yield "join-page-breaks", ["-p", "-s"] + movements
+    yield "join-repeat", movements + movements
+    yield "stream", ["--stream", "-p", "-s"] + movements + movements
+    for template in ["Template.mscx", "Template2.mscx"]:
+        yield "template-" + template, ["-t", os.path.join(test, template)]
+
+def run(backend, arguments):
+    # returns (output, seconds) of mscore-join.py using the given backend
+    env = dict(os.environ, MSCORE_XML=backend)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, join] + arguments, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return result.stdout, time.perf_counter() - start
+
+def backend_available(name):
+    env = dict(os.environ, MSCORE_XML=name)
+    code = "import xmlbackend; print(xmlbackend.NAME)"
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(join),
+                            stdout=subprocess.PIPE, text=True, check=True)
+    return result.stdout.strip() == name
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the XML backends give identical output for the test scores.")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="run each case this many times and report the fastest")
+    args = parser.parse_args()
+
+    if not backend_available("lxml"):
+        print("lxml is not installed, so the backends can't be compared.", file=sys.stderr)
+        sys.exit(1)
+
+    failures = 0
+    for name, arguments in cases():
+        outputs = {}
+        times = {}
+        for backend in ["etree", "lxml"]:
+            runs = [run(backend, arguments) for _ in range(args.repeat)]
+            outputs[backend] = runs[0][0]
+            times[backend] = min(seconds for output, seconds in runs)
+        same = outputs["etree"] == outputs["lxml"]
+        failures += not same
+        print("%-26s %-9s etree %7.3f s  lxml %7.3f s"
+              % (name, "same" if same else "DIFFERENT", times["etree"], times["lxml"]))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Time and memory-profile the main join operations on synthetic scores of
+# increasing size, and append the results to a JSON Lines file so that
+# scaling regressions (e.g. a join becoming quadratic) show up quickly.
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+
+import generate
+import recipe
+import score
+
+def measure(fn):
+    # returns (seconds, peak bytes allocated) for calling fn
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()): # hide join log messages
+        fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+def exponent(sizes, values):
+    # slope of log(value) against log(size): ~1 for linear, ~2 for quadratic
+    points = [(math.log(s), math.log(v)) for s, v in zip(sizes, values) if v > 0]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, y in points) / len(points)
+    my = sum(y for x, y in points) / len(points)
+    sxx = sum((x - mx) ** 2 for x, y in points)
+    sxy = sum((x - mx) * (y - my) for x, y in points)
+    return sxy / sxx if sxx else None
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_size(directory, n, args):
+    # run every benchmark with n movements (or n parts for instrument names)
+    kwargs = dict(parts=args.parts, staves_per_part=args.staves, measures=args.measures,
+                  time_sigs=args.time_sig, density=args.density)
+    book = generate.generate_book(os.path.join(directory, str(n)), n, seed=args.seed, **kwargs)
+    files = recipe.Recipe(yaml.safe_load(open(book))).scores()
+    results = {}
+
+    scores = [score.ScoreFile(f) for f in files]
+    def join():
+        j = score.ScoreJoin(scores[0])
+        for s in scores[1:]:
+            j.append_score(s, False, True, True)
+    results["append_score"] = measure(join)
+
+    joined = scores[0]
+    path = os.path.join(directory, "joined%d.mscx" % n)
+    with open(path, "wb") as f:
+        joined.writeToFile(f)
+    # the joined score's timeline is already built, so time a fresh parse
+    fresh = score.ScoreFile(path)
+    results["ticks"] = measure(fresh.ticks)
+    results["writeToFile"] = measure(lambda: joined.writeToFile(io.BytesIO()))
+
+    kwargs["parts"] = n
+    path = os.path.join(directory, "template%d.mscx" % n)
+    generate.write_score(generate.generate_score(seed=args.seed, **kwargs), path)
+    template = score.ScoreFile(path)
+    results["fix_instrument_names"] = measure(template.fix_instrument_names)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark joins of synthetic scores of increasing size.")
+    parser.add_argument("-n", "--sizes", type=lambda s: [int(n) for n in s.split(",")], default=[4, 8, 16, 32, 64],
+                        help="comma-separated numbers of movements (and template parts) to try (default 4,8,16,32,64)")
+    parser.add_argument("-p", "--parts", type=int, default=4, help="parts per movement (default 4)")
+    parser.add_argument("-s", "--staves", type=int, default=1, help="staves per part (default 1)")
+    parser.add_argument("-m", "--measures", type=int, default=64, help="measures per movement (default 64)")
+    parser.add_argument("-t", "--time-sig", type=generate.time_sig, action="append", help="time signature, e.g. 3/4 (repeat to cycle through several)")
+    parser.add_argument("-d", "--density", type=float, default=0.75, help="chance of a beat having notes (default 0.75)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-o", "--output", default=os.path.join(here, "results.jsonl"), help="append results to this file (default bench/results.jsonl)")
+    parser.add_argument("--max-exponent", type=float, default=1.5, help="warn if time grows faster than size to this power (default 1.5)")
+    args = parser.parse_args()
+    args.time_sig = args.time_sig or [(4,4), (3,4), (6,8)]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n in args.sizes:
+            for name, (seconds, peak) in bench_size(directory, n, args).items():
+                rows.append({"benchmark": name, "size": n, "seconds": seconds, "peak_bytes": peak})
+                print("%-22s %6d %10.4f s %12d B" % (name, n, seconds, peak))
+
+    exponents = {}
+    warnings = 0
+    for name in dict.fromkeys(r["benchmark"] for r in rows):
+        sizes = [r["size"] for r in rows if r["benchmark"] == name]
+        e = exponent(sizes, [r["seconds"] for r in rows if r["benchmark"] == name])
+        exponents[name] = e
+        if e is None:
+            continue
+        print("%-22s time ~ size^%.2f" % (name, e))
+        if e > args.max_exponent:
+            print("WARNING: %s scales worse than size^%s" % (name, args.max_exponent), file=sys.stderr)
+            warnings += 1
+
+    record = {
+        "date": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": revision(),
+        "settings": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": rows,
+        "exponents": exponents,
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    sys.exit(1 if warnings else 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Time `mscore-join.py` on a generated book without a score cache, and with
+# a cold and a warm --cache-dir (and with -j, to see the workers use the
+# cache too). A warm cache appends scores as bytes instead of parsing them,
+# so it should beat no cache; exits non-zero if it doesn't, or if any run
+# gives different output. Uses the XML backend in use (set MSCORE_XML to try
+# the other).
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+join = os.path.join(here, "..", "mscore-python", "mscore-join.py")
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+
+import generate
+import xmlbackend
+
+def run(arguments):
+    # seconds taken and output of a join
+    env = dict(os.environ)
+    env.pop("MSCORE_JOIN_SOCKET", None) # join here, not in a server
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, join] + arguments, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start, result.stdout
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare joins with and without a warm --cache-dir.")
+    parser.add_argument("-n", "--movements", type=int, default=12, help="number of scores (default 12)")
+    parser.add_argument("-p", "--parts", type=int, default=8, help="parts per score (default 8)")
+    parser.add_argument("-m", "--measures", type=int, default=200, help="measures per score (default 200)")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="also time a warm cache with this many jobs (default 2, 1 to skip)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="time each case this many times and report the fastest")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        generate.generate_book(directory, args.movements, seed=args.seed, parts=args.parts, measures=args.measures)
+        files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".mscx"))
+        size = sum(os.path.getsize(f) for f in files)
+        cacheDir = os.path.join(directory, "cache")
+        cached = ["--cache-dir", cacheDir]
+
+        def cold():
+            shutil.rmtree(cacheDir, ignore_errors=True)
+            return run(cached + files)
+
+        cases = [("no cache", lambda: run(files)),
+                 ("cold cache", cold),
+                 ("warm cache", lambda: run(cached + files))]
+        if args.jobs > 1:
+            cases.append(("warm cache -j %d" % args.jobs, lambda: run(cached + ["-j", str(args.jobs)] + files)))
+
+        results = []
+        outputs = set()
+        for name, fn in cases:
+            times = []
+            for _ in range(args.repeat):
+                seconds, output = fn()
+                times.append(seconds)
+                outputs.add(output)
+            results.append((name, min(times)))
+
+    print("%s backend, %d scores, %d bytes of XML" % (xmlbackend.NAME, len(files), size))
+    noCache = results[0][1]
+    for name, seconds in results:
+        print("%-20s %8.3f s  %5.2fx no cache" % (name, seconds, seconds / noCache))
+    failed = False
+    if len(outputs) != 1:
+        print("the joins gave different output")
+        failed = True
+    if results[2][1] > noCache:
+        print("a warm cache is slower than no cache")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Generate synthetic MuseScore 3 scores, and recipes that join them, for use
+# in benchmarks. Scores are random but reproducible for a given seed.
+
+import argparse
+import os
+import random
+import xml.etree.ElementTree as ET
+
+# (longName, shortName, instrumentId) - some use solfège key names so that
+# ScoreFile.fix_instrument_names has work to do.
+INSTRUMENTS = [
+    ("Flute", "Fl.", "wind.flutes.flute"),
+    ("Oboe", "Ob.", "wind.reed.oboe"),
+    ("Clarinet in Si♭", "Cl. in Si♭", "wind.reed.clarinet.bflat"),
+    ("Bassoon", "Bsn.", "wind.reed.bassoon"),
+    ("Horn in Fa", "Hn. in Fa", "brass.french-horn"),
+    ("Trumpet in Do", "Tpt. in Do", "brass.trumpet.c"),
+    ("Violin", "Vln.", "strings.violin"),
+    ("Viola", "Vla.", "strings.viola"),
+    ("Violoncello", "Vc.", "strings.cello"),
+    ("Piano", "Pno.", "keyboard.piano"),
+]
+
+DURATION_TYPES = {1: "whole", 2: "half", 4: "quarter", 8: "eighth", 16: "16th"}
+
+def _sub(parent, tag, text=None, **attrib):
+    e = ET.SubElement(parent, tag, attrib)
+    if text is not None:
+        e.text = str(text)
+    return e
+
+def _part(score, instrument, staff_ids):
+    long_name, short_name, instrument_id = instrument
+    part = _sub(score, "Part")
+    for id in staff_ids:
+        staff = _sub(part, "Staff", id=str(id))
+        staff_type = _sub(staff, "StaffType", group="pitched")
+        _sub(staff_type, "name", "stdNormal")
+    _sub(part, "trackName", long_name)
+    inst = _sub(part, "Instrument")
+    _sub(inst, "longName", long_name)
+    _sub(inst, "shortName", short_name)
+    _sub(inst, "trackName", long_name)
+    _sub(inst, "instrumentId", instrument_id)
+    channel = _sub(inst, "Channel")
+    _sub(channel, "program", value="0")
+    return part
+
+def _voice(measure, timesig, firstMeasure, changeTimeSig, density, rng, ids):
+    n, d = timesig
+    voice = _sub(measure, "voice")
+    if firstMeasure:
+        keysig = _sub(voice, "KeySig")
+        _sub(keysig, "accidental", rng.randint(-3, 3))
+    if changeTimeSig:
+        ts = _sub(voice, "TimeSig")
+        _sub(ts, "sigN", n)
+        _sub(ts, "sigD", d)
+    if rng.random() >= density:
+        rest = _sub(voice, "Rest")
+        _sub(rest, "durationType", "measure")
+        _sub(rest, "duration", "%d/%d" % (n, d))
+        return
+    beam = None
+    for beat in range(n):
+        if rng.random() >= density:
+            rest = _sub(voice, "Rest")
+            _sub(rest, "durationType", DURATION_TYPES[d])
+            beam = None
+            continue
+        if d >= 8:
+            if beam is None or beat % 2 == 0:
+                # new beam (referenced by ID from the chords in it)
+                ids[0] += 1
+                beam = ids[0]
+                beam_def = _sub(voice, "Beam", id=str(beam))
+                _sub(beam_def, "l1", -8)
+                _sub(beam_def, "l2", -8)
+        chord = _sub(voice, "Chord")
+        if d >= 8:
+            _sub(chord, "Beam", beam)
+        _sub(chord, "durationType", DURATION_TYPES[d])
+        for pitch in rng.sample(range(48, 84), rng.randint(1, 3)):
+            note = _sub(chord, "Note")
+            _sub(note, "pitch", pitch)
+            _sub(note, "tpc", 14 + (pitch * 7) % 12 - 6)
+
+def generate_score(parts=2, staves_per_part=1, measures=32, time_sigs=((4,4),),
+                   measures_per_time_sig=8, density=0.75, seed=0, title="Title"):
+    # Returns an ElementTree for a score with the given number of parts,
+    # staves and measures. The time signature changes every
+    # measures_per_time_sig measures, cycling through time_sigs. density is
+    # the probability of a beat (or measure) containing notes, not rests.
+    rng = random.Random(seed)
+    root = ET.Element("museScore", version="3.01")
+    _sub(root, "programVersion", "3.5.0")
+    score = _sub(root, "Score")
+    _sub(score, "Division", 480)
+    style = _sub(score, "Style")
+    _sub(style, "Spatium", "1.76389")
+    for tag in ["showInvisible", "showUnprintable", "showFrames", "showMargins"]:
+        _sub(score, tag, 1)
+    for name in ["movementNumber", "movementTitle", "source"]:
+        _sub(score, "metaTag", "", name=name)
+    _sub(score, "metaTag", title, name="workTitle")
+
+    staff_id = 1
+    for p in range(parts):
+        ids = range(staff_id, staff_id + staves_per_part)
+        _part(score, INSTRUMENTS[p % len(INSTRUMENTS)], ids)
+        staff_id += staves_per_part
+
+    ids = [0] # last element ID used
+    for id in range(1, staff_id):
+        staff = _sub(score, "Staff", id=str(id))
+        if id == 1:
+            vbox = _sub(staff, "VBox")
+            _sub(vbox, "height", 10)
+            text = _sub(vbox, "Text")
+            _sub(text, "style", "Title")
+            _sub(text, "text", title)
+        for m in range(measures):
+            measure = _sub(staff, "Measure")
+            change = m % measures_per_time_sig == 0
+            timesig = time_sigs[(m // measures_per_time_sig) % len(time_sigs)]
+            _voice(measure, timesig, m == 0, change, density, rng, ids)
+    ET.indent(root, space="  ")
+    return ET.ElementTree(root)
+
+def write_score(tree, path):
+    tree.write(path, encoding="UTF-8", xml_declaration=True)
+
+def generate_book(directory, movements=24, **kwargs):
+    # Write `movements` scores and a recipe that joins them to directory.
+    # Returns the path of the recipe. kwargs are passed to generate_score.
+    os.makedirs(directory, exist_ok=True)
+    seed = kwargs.pop("seed", 0)
+    names = []
+    for m in range(1, movements + 1):
+        name = "Mvt%03d" % m
+        tree = generate_score(seed=seed + m, title="Movement %d" % m, **kwargs)
+        write_score(tree, os.path.join(directory, name + ".mscx"))
+        names.append(name)
+    recipe = os.path.join(directory, "book.yml")
+    with open(recipe, "w") as f:
+        f.write("structure:\n")
+        for name in names:
+            f.write("  - score: %s\n" % os.path.join(directory, name))
+    return recipe
+
+def time_sig(text):
+    n, d = text.split("/")
+    return (int(n), int(d))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic scores and a recipe that joins them.")
+    parser.add_argument("directory", help="where to write the scores and book.yml")
+    parser.add_argument("-n", "--movements", type=int, default=24, help="number of scores (default 24)")
+    parser.add_argument("-p", "--parts", type=int, default=4, help="parts per score (default 4)")
+    parser.add_argument("-s", "--staves", type=int, default=1, help="staves per part (default 1)")
+    parser.add_argument("-m", "--measures", type=int, default=64, help="measures per score (default 64)")
+    parser.add_argument("-t", "--time-sig", type=time_sig, action="append", help="time signature, e.g. 3/4 (repeat to cycle through several)")
+    parser.add_argument("-d", "--density", type=float, default=0.75, help="chance of a beat having notes (default 0.75)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    recipe = generate_book(args.directory, args.movements, parts=args.parts,
+                           staves_per_part=args.staves, measures=args.measures,
+                           time_sigs=args.time_sig or [(4,4)],
+                           density=args.density, seed=args.seed)
+    print(recipe)
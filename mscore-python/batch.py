@@ -0,0 +1,146 @@
+import functools
+import multiprocessing
+import os
+import sys
+import time
+import yaml
+import cache
+import recipe
+import score
+import timings
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+def recipe_files(paths):
+    # expand directories into the recipes (.yml files) they contain
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".yml")))
+        else:
+            files.append(path)
+    return files
+
+def output_path(recipeFile, outputDir=None, mscz=False):
+    dirname, basename = os.path.split(recipeFile)
+    name = os.path.splitext(basename)[0] + (".mscz" if mscz else ".mscx")
+    return os.path.join(outputDir if outputDir else dirname, name)
+
+def _init_timed_worker(settings, initializer, initargs):
+    timings.start_worker(settings)
+    if initializer is not None:
+        initializer(*initargs)
+
+def _timed(function, task):
+    # for worker processes: send back timings along with the result
+    return function(task), timings.take() if timings.enabled() else None
+
+def _map(function, tasks, jobs, initializer=None, initargs=()):
+    # results of function for every task (in any order), running up to `jobs`
+    # tasks at once, with the timings of the workers added to this process's
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(task) for task in tasks]
+    results = []
+    with multiprocessing.Pool(jobs, _init_timed_worker, (timings.worker_settings(), initializer, initargs)) as pool:
+        for result, records in pool.imap_unordered(functools.partial(_timed, function), tasks):
+            if records:
+                timings.extend(records)
+            results.append(result)
+    return results
+
+# Scores shared by all recipes built in this process. Set per worker so each
+# worker process has its own.
+_scoreCache = None
+
+def _init_worker(diskCache):
+    global _scoreCache
+    _scoreCache = cache.MemoryScoreCache(parent=diskCache)
+    if diskCache is not None:
+        # only forked workers inherit this from cli.open_cache
+        score.set_template_cache_dir(os.path.join(diskCache.path, "jinja"))
+
+def _build(task):
+    recipeFile, outputFile, multiMeasureRests, compressLevel = task
+    start = time.perf_counter()
+    try:
+        r = recipe.Recipe(yaml.safe_load(open(recipeFile)))
+        if not r.scores():
+            raise ValueError("No scores!")
+        join = r.join(scoreCache=_scoreCache)
+        if multiMeasureRests:
+            join.scoreFile.show_multimeasure_rests()
+        score.write_file(join, outputFile, compressLevel)
+        error = None
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    return recipeFile, outputFile, time.perf_counter() - start, error
+
+def build_recipes(paths, outputDir=None, jobs=1, diskCache=None, multiMeasureRests=False, mscz=False, compressLevel=6):
+    # Build every recipe in paths (files or directories) to its own output
+    # file, running up to `jobs` recipes at once. Returns number of failures.
+    tasks = [(f, output_path(f, outputDir, mscz), multiMeasureRests, compressLevel) for f in recipe_files(paths)]
+    if outputDir:
+        os.makedirs(outputDir, exist_ok=True)
+    start = time.perf_counter()
+    results = _map(_build, tasks, jobs, _init_worker, (diskCache,))
+    failures = 0
+    eprint("seconds\trecipe\toutput")
+    for recipeFile, outputFile, seconds, error in sorted(results):
+        eprint("%.3f\t%s\t%s" % (seconds, recipeFile, error if error else outputFile))
+        if error:
+            failures += 1
+    eprint("%.3f\ttotal (%d recipes, %d failed)" % (time.perf_counter() - start, len(results), failures))
+    return failures
+
+def template_files(paths):
+    # expand directories into the scores (.mscx and .mscz files) they contain
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                if f.lower().endswith((".mscx", ".mscz"))))
+        else:
+            files.append(path)
+    return files
+
+def _no_log(*args):
+    pass
+
+def _fix_template(task):
+    templateFile, outputFile, compressLevel = task
+    start = time.perf_counter()
+    try:
+        scoreFile = score.ScoreFile(templateFile)
+        with timings.phase('fix names', templateFile):
+            scoreFile.fix_instrument_names(log=_no_log)
+        with timings.phase('serialize', templateFile):
+            score.write_file(scoreFile, outputFile, compressLevel)
+        error = None
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    return templateFile, outputFile, time.perf_counter() - start, error
+
+def fix_templates(paths, outputDir=None, jobs=1, mscz=False, compressLevel=6):
+    # Fix the instrument names of every template in paths (files or
+    # directories), writing each to outputDir (as .mscz if mscz), or over the
+    # template if there is no outputDir, and fixing up to `jobs` at once.
+    # Returns number of failures.
+    tasks = []
+    for f in template_files(paths):
+        outputFile = output_path(f, outputDir, mscz or score.is_mscz(f)) if outputDir else f
+        tasks.append((f, outputFile, compressLevel))
+    if outputDir:
+        os.makedirs(outputDir, exist_ok=True)
+    start = time.perf_counter()
+    results = _map(_fix_template, tasks, jobs)
+    failures = 0
+    eprint("seconds\ttemplate\toutput")
+    for templateFile, outputFile, seconds, error in sorted(results):
+        eprint("%.3f\t%s\t%s" % (seconds, templateFile, error if error else outputFile))
+        if error:
+            failures += 1
+    eprint("%.3f\ttotal (%d templates, %d failed)" % (time.perf_counter() - start, len(results), failures))
+    return failures
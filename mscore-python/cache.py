@@ -0,0 +1,281 @@
+import collections
+import copy
+import hashlib
+import os
+import pickle
+import rawjoin
+import score
+import tempfile
+import timings
+import xmlbackend
+
+# Bump when the cached form of a score changes so old entries are ignored.
+CACHE_VERSION = "6"
+
+def file_key(filePath):
+    # entries made with one XML backend can't be loaded with the other
+    h = hashlib.sha256((CACHE_VERSION + xmlbackend.NAME).encode())
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class CachedScore:
+    # A score as the score caches keep it: serialized, and normalized if it
+    # is to be appended, with its stats and measure timeline. raw says if
+    # rawjoin can append the XML as bytes, giving the same output as the
+    # tree join (see rawjoin.same_numbers), so that a cached score is
+    # appended without being parsed, shifted or serialized (see
+    # CachedScoreJoin). The XML is the same with either backend.
+    def __init__(self, xml, stats, timeline, raw):
+        self.xml = xml
+        self.stats = stats
+        self.timeline = timeline
+        self.raw = raw
+        self.fresh = None # the ScoreFile it was made from, to hand out once
+        self.keep = False # keep a tree to copy for each ScoreFile (MemoryScoreCache)
+        self.tree = None
+
+    @classmethod
+    def from_score(cls, scoreFile, appended):
+        xml = xmlbackend.tostring(scoreFile.root)
+        raw = False
+        if appended:
+            try:
+                raw = rawjoin.same_numbers(rawjoin.RawScore(scoreFile.filePath, xml), scoreFile)
+            except rawjoin.NotRaw:
+                pass
+        cached = cls(xml, scoreFile.stats(), copy.deepcopy(scoreFile.timeline), raw)
+        cached.fresh = scoreFile
+        return cached
+
+    def scoreFile(self, filePath):
+        # a ScoreFile of the score, which the caller may modify
+        if self.fresh is not None:
+            scoreFile, self.fresh = self.fresh, None
+            return scoreFile
+        if self.keep:
+            if self.tree is None:
+                self.tree = copyable(xmlbackend.fromstring(self.xml))
+            root = xmlbackend.deepcopy(self.tree)
+        else:
+            with timings.phase('parse', filePath):
+                root = xmlbackend.fromstring(self.xml)
+        return score.ScoreFile(filePath, root=root, stats=self.stats)
+
+    def raw_score(self, filePath):
+        # a rawjoin.RawScore of the XML, if raw
+        return rawjoin.RawScore(filePath, self.xml)
+
+    def shifted_stats(self, idOffset, measureOffset):
+        # stats as ScoreFile.normalize_and_shift would return them, or at
+        # least with the same effect on the totals of a join
+        return score.ScoreStats(self.stats.maxElementID + idOffset, self.stats.maxMeasureNumber + measureOffset,
+                                self.stats.ticks)
+
+def copyable(root):
+    # etree keeps parsed text in pieces until it is read, and copies the
+    # pieces with it, which makes a copy slower than a parse
+    for e in root.iter():
+        e.text, e.tail
+    return root
+
+def load(scoreCache, filePath, appended=True):
+    # The CachedScore of filePath from scoreCache, parsing it and adding it
+    # to scoreCache if it isn't there. Scores that are to be appended are
+    # normalized, as the first score of a join isn't.
+    with timings.phase('cache load', filePath):
+        key = scoreCache.key(filePath) + ("" if appended else "-first")
+        cached = scoreCache.get(key)
+    if cached is None:
+        scoreFile = score.ScoreFile(filePath)
+        if appended:
+            score.normalize_score(scoreFile)
+        with timings.phase('cache store', filePath):
+            cached = CachedScore.from_score(scoreFile, appended)
+            scoreCache.put(key, cached)
+    return cached
+
+class ScoreCache:
+    # On-disk cache of scores (CachedScore) keyed by a hash of the file's
+    # contents. Least recently used entries are evicted once the total size
+    # of the cache exceeds maxSize bytes.
+    def __init__(self, path, maxSize=512*1024*1024):
+        self.path = path
+        self.maxSize = maxSize
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, filePath):
+        return file_key(filePath)
+
+    def load(self, filePath, appended=True):
+        return load(self, filePath, appended)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def get(self, key):
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None # not cached (or entry was evicted or is corrupt)
+        try:
+            os.utime(entry) # mark as recently used
+        except OSError:
+            pass # evicted by another process in the meantime
+        xml, stats, timeline, raw = data
+        return CachedScore(xml, stats, timeline, raw)
+
+    def put(self, key, value):
+        # write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            data = (value.xml, value.stats, value.timeline, value.raw)
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._entry(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for e in os.scandir(self.path):
+            if not e.name.endswith(".pickle"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue # removed by another process
+            entries.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+        entries.sort() # oldest first
+        for mtime, size, path in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass # removed by another process
+            total -= size
+
+
+class MemoryScoreCache:
+    # In-process cache of scores (CachedScore), optionally in front of an
+    # on-disk ScoreCache. Entries that are needed as trees keep a parsed tree
+    # as well as the XML, and every ScoreFile made from them gets a copy of
+    # it, because joining modifies the scores that are appended; copying a
+    # tree is several times faster than parsing it again with etree (and no
+    # slower with lxml).
+    TREE_SIZE = 11 # a parsed tree takes about this many times the memory of its XML
+
+    def __init__(self, maxSize=256*1024*1024, parent=None):
+        self.maxSize = maxSize
+        self.parent = parent
+        self.size = 0
+        self.entries = collections.OrderedDict() # least recently used first
+
+    def __getstate__(self):
+        # only the parent goes to pool workers (lxml trees can't be pickled)
+        state = self.__dict__.copy()
+        state['size'] = 0
+        state['entries'] = collections.OrderedDict()
+        return state
+
+    def key(self, filePath):
+        return file_key(filePath)
+
+    def load(self, filePath, appended=True):
+        return load(self, filePath, appended)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[0]
+        if self.parent is None:
+            return None
+        value = self.parent.get(key)
+        if value is not None:
+            self._store(key, value)
+        return value
+
+    def put(self, key, value):
+        self._store(key, value)
+        if self.parent is not None:
+            self.parent.put(key, value)
+
+    def _store(self, key, value):
+        kept = CachedScore(value.xml, value.stats, value.timeline, value.raw)
+        kept.keep = True
+        if value.fresh is not None and not value.raw:
+            # copy the tree before the caller modifies it (otherwise it is
+            # parsed if it is needed, which it usually isn't if raw)
+            kept.tree = copyable(xmlbackend.deepcopy(value.fresh.root))
+        size = len(value.xml) * (1 + self.TREE_SIZE) # if it gets a tree
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (kept, size)
+        self.size += size
+        while self.size > self.maxSize and self.entries:
+            key, (kept, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+
+class CachedScoreJoin(score.StreamingScoreJoin):
+    # StreamingScoreJoin that appends score files from a score cache, as
+    # bytes where it can: the cached XML is indexed with rawjoin.RawScore and
+    # copied into the spools with its numbers shifted, so the score is not
+    # parsed, shifted or serialized. That needs the cache to have found that
+    # this gives the same output as the tree join (CachedScore.raw), and the
+    # score to have the same parts and staves as the first score (filler
+    # needs trees). Other scores are appended as trees. The final measure of
+    # the first staff of a score appended as bytes is held back, like the one
+    # StreamingScoreJoin keeps in the tree, until a later measure is appended
+    # or the join is written, as layout breaks may be added to it.
+    def __init__(self, scoreFile, scoreCache):
+        self.scoreCache = scoreCache
+        self.pending = None # (RawScore, offsets) of a held back final measure
+        super().__init__(scoreFile)
+
+    def append_file(self, filePath, addLineBreak, addPageBreak, addSectionBreak):
+        cached = self.scoreCache.load(filePath)
+        if cached.raw:
+            rawScore = cached.raw_score(filePath)
+            if rawScore.can_append_to(self.scoreFile.index):
+                self.append_raw(rawScore, cached, addLineBreak, addPageBreak, addSectionBreak)
+                return
+        self.append_score(cached.scoreFile(filePath), addLineBreak, addPageBreak, addSectionBreak)
+
+    def append_raw(self, rawScore, cached, addLineBreak, addPageBreak, addSectionBreak):
+        self.add_layout_breaks(addLineBreak, addPageBreak, addSectionBreak)
+        self.flush(keepFinalMeasure=False)
+        measureOffset = 0 if addSectionBreak else self.maxMeasureNumber
+        offsets = rawjoin.shift(self.maxElementID, measureOffset, self.ticks)
+        with timings.phase('append', rawScore.filePath):
+            rawScore.append_staves(self.spools, offsets)
+        self.pending = (rawScore, offsets)
+        self.add_stats(cached.shifted_stats(self.maxElementID, measureOffset), cached.timeline)
+
+    def add_layout_breaks(self, addLineBreak, addPageBreak, addSectionBreak):
+        if self.pending is None:
+            return super().add_layout_breaks(addLineBreak, addPageBreak, addSectionBreak)
+        rawScore, offsets = self.pending
+        for type in score.layout_break_types(addLineBreak, addPageBreak, addSectionBreak):
+            rawScore.appendLayoutBreak(type)
+        return []
+
+    def flush(self, keepFinalMeasure=True):
+        staves = zip(self.scoreFile.staves, self.spools)
+        if self.pending is not None:
+            if keepFinalMeasure and self.scoreFile.finalMeasure() is None:
+                # the held back measure is still the final one, and the rest
+                # of the first staff has to follow it
+                next(staves)
+            else:
+                rawScore, offsets = self.pending
+                rawScore.append_final(self.spools[0], offsets)
+                self.pending = None
+        for staff, spool in staves:
+            self.flush_staff(staff, spool, keepFinalMeasure)
@@ -0,0 +1,218 @@
+import argparse
+import batch
+import cache
+import json
+import os
+import paralleljoin
+import plan
+import rawjoin
+import recipe
+import score
+import shlex
+import sys
+import timings
+import watch
+import yaml
+
+# The body of mscore-join.py, run with its parsed arguments. Shared by the
+# command line and the join server so both behave the same.
+
+def open_cache(args):
+    if not args.cache_dir:
+        return None
+    score.set_template_cache_dir(os.path.join(args.cache_dir, "jinja"))
+    return cache.ScoreCache(args.cache_dir, args.cache_size*1024*1024)
+
+def write_output(args, output, file, firstScore):
+    if args.mscz:
+        name = os.path.splitext(os.path.basename(firstScore))[0] + ".mscx"
+        score.write_mscz(output, file, name, args.compression_level)
+    else:
+        output.writeToFile(file)
+
+# --variant "OUTPUT [options]" joins the same scores to another file
+variant_parser = argparse.ArgumentParser(prog="--variant", description="an output of the join, written to OUTPUT (.mscx or .mscz)")
+variant_parser.add_argument("output", help="output file")
+variant_breaks = variant_parser.add_mutually_exclusive_group()
+variant_breaks.add_argument("-l", "--line-breaks", action="store_true", help="add line breaks between scores")
+variant_breaks.add_argument("-p", "--page-breaks", action="store_true", help="add page breaks between scores")
+variant_parser.add_argument("-s", "--section-breaks", action="store_true", help="add section breaks between scores")
+variant_parser.add_argument("-c", "--cover", type=str, action="append", default=[], help="insert frames from score file")
+
+def parse_variant(spec):
+    return variant_parser.parse_args(shlex.split(spec))
+
+def add_covers(firstScore, covers, dictionary):
+    firstScore['movementNumber'] = ""
+    firstScore['movementTitle'] = ""
+    firstScore.set_style('footerFirstPage', '0')
+    firstScore.score.find('showInvisible').text = '0'
+    firstScore.score.find('showUnprintable').text = '0'
+    firstScore.score.find('showFrames').text = '0'
+    firstScore.score.find('showMargins').text = '0'
+    for cover in reversed(covers):
+        firstScore.prepend_cover(score.ScoreFile(cover, dictionary))
+
+def run_variants(args, firstScore, files, dictionary, scoreCache=None):
+    # Write every --variant, parsing and appending the scores only once for
+    # all of them unless they need different measure numbers.
+    variants = [parse_variant(spec) for spec in args.variant]
+    firstPath = firstScore.filePath
+    source = firstScore['source']
+    while variants:
+        if firstScore is None:
+            firstScore = score.load_score(firstPath, scoreCache, normalize=False)
+            firstScore['source'] = source
+            if args.multimeasure_rests:
+                firstScore.show_multimeasure_rests()
+        join = score.VariantScoreJoin(firstScore, variants[0].section_breaks)
+        for variant in variants:
+            if variant.cover:
+                # IDs of appended scores must follow those of any cover
+                saved = firstScore.save_header()
+                add_covers(firstScore, variant.cover, dictionary)
+                join.maxElementID = max(join.maxElementID, firstScore.maxElementID())
+                firstScore.restore_header(saved)
+        for scoreFile in score.load_scores(files, scoreCache):
+            join.append_score(scoreFile)
+
+        remaining = []
+        for variant in variants:
+            if not join.can_write(variant.section_breaks):
+                remaining.append(variant)
+                continue
+            saved = firstScore.save_header()
+            if variant.cover:
+                add_covers(firstScore, variant.cover, dictionary)
+            join.select(variant.line_breaks, variant.page_breaks, variant.section_breaks)
+            score.write_file(join, variant.output, args.compression_level)
+            firstScore.restore_header(saved)
+        variants = remaining
+        firstScore = None
+
+def raw_join(filePaths, addLineBreak, addPageBreak, addSectionBreak):
+    # join as raw bytes if the scores allow it, otherwise return None
+    try:
+        return rawjoin.join(filePaths, addLineBreak, addPageBreak, addSectionBreak)
+    except rawjoin.NotRaw as e:
+        print("Can't join as raw bytes (%s) so doing a normal join" % e, file=sys.stderr)
+        return None
+
+def run(args, file, scoreCache=None):
+    # Write the output for args to file and return the exit status.
+    if args.timings:
+        timings.enable(args.trace_memory)
+    status = _run(args, file, scoreCache)
+    if args.timings:
+        timings.write(args.timings)
+    return status
+
+def _run(args, file, scoreCache):
+    files = list(args.files)
+
+    if args.watch:
+        # rebuild the recipe's output file whenever its files change
+        outputFile = batch.output_path(files[0], args.output_dir, args.mscz)
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+        def write(join):
+            if args.multimeasure_rests:
+                join.scoreFile.show_multimeasure_rests()
+            score.write_file(join, outputFile, args.compression_level)
+        watch.watch_recipe(files[0], write, scoreCache)
+        return 0
+
+    if args.plan:
+        # print what the join(s) would do as JSON, and fail if any can't be done
+        if files[0].endswith(".yml") or os.path.isdir(files[0]):
+            plans = {}
+            for recipeFile in batch.recipe_files(files):
+                plans[recipeFile] = recipe.Recipe(yaml.safe_load(open(recipeFile))).plan()
+            failed = any(p["errors"] for p in plans.values())
+        else:
+            plans = plan.plan(files, args.line_breaks, args.page_breaks, args.section_breaks, args.cover or [])
+            failed = bool(plans["errors"])
+        file.write((json.dumps(plans, indent=2) + "\n").encode())
+        return 1 if failed else 0
+
+    if args.template and (len(files) > 1 or os.path.isdir(files[0]) or args.output_dir or args.in_place):
+        # fix several templates, each to its own file
+        return 1 if batch.fix_templates(files, args.output_dir, args.jobs, args.mscz, args.compression_level) else 0
+
+    if (len(files) > 1 and files[0].endswith(".yml")) or os.path.isdir(files[0]) or args.output_dir:
+        # build several recipes, each to its own file
+        return 1 if batch.build_recipes(files, args.output_dir, args.jobs, scoreCache, args.multimeasure_rests,
+                                         args.mscz, args.compression_level) else 0
+
+    if files[0].endswith(".yml"):
+        r = recipe.Recipe(yaml.safe_load(open(files[0])))
+        scores = r.scores()
+        if not scores:
+            print("No scores!", file=sys.stderr)
+            return 1
+        join = None
+        if args.raw and not (r.covers() or args.multimeasure_rests):
+            join = raw_join(scores, False, True, True)
+        if join is None:
+            join = r.join(args.jobs, scoreCache)
+            if args.multimeasure_rests:
+                join.scoreFile.show_multimeasure_rests()
+        write_output(args, join, file, scores[0])
+        return 0
+
+    if args.raw and not (args.template or args.dictionary or args.cover or args.stream or args.multimeasure_rests):
+        join = raw_join(files, args.line_breaks, args.page_breaks, args.section_breaks)
+        if join is not None:
+            write_output(args, join, file, files[0])
+            return 0
+
+    firstScore = score.load_score(files.pop(0), scoreCache, normalize=False)
+
+    if args.template:
+        with timings.phase('fix names', firstScore.filePath):
+            firstScore.fix_instrument_names()
+        write_output(args, firstScore, file, firstScore.filePath)
+        return 0
+
+    if args.multimeasure_rests:
+        firstScore.show_multimeasure_rests()
+
+    dictionary = {}
+    if args.dictionary:
+        for path in args.dictionary:
+            d = yaml.safe_load(open(path))
+            dictionary.update(d)
+        score_id = dictionary['id']['musescore']
+        if isinstance(score_id, int) or score_id.isdigit():
+            score_url = "https://musescore.com/score/{0}".format(score_id)
+        else:
+            score_url = ""
+        firstScore['source'] = score_url
+
+    if args.variant:
+        run_variants(args, firstScore, files, dictionary, scoreCache)
+        return 0
+
+    if args.cover:
+        add_covers(firstScore, args.cover, dictionary)
+
+    if args.jobs > 1:
+        # shift and serialize the scores in parallel (streams as well)
+        join = paralleljoin.ParallelScoreJoin(firstScore)
+        join.append_files(files, args.line_breaks, args.page_breaks, args.section_breaks, args.jobs, scoreCache)
+    elif scoreCache is not None:
+        # appends cached scores as bytes where it can (streams as well)
+        join = cache.CachedScoreJoin(firstScore, scoreCache)
+        for filePath in files:
+            join.append_file(filePath, args.line_breaks, args.page_breaks, args.section_breaks)
+    else:
+        if args.stream:
+            join = score.StreamingScoreJoin(firstScore)
+        else:
+            join = score.ScoreJoin(firstScore)
+        for scoreFile in score.load_scores(files):
+            join.append_score(scoreFile, args.line_breaks, args.page_breaks, args.section_breaks)
+
+    write_output(args, join, file, firstScore.filePath)
+
+    return 0
@@ -0,0 +1,32 @@
+import json
+import os
+import socket
+import sys
+
+# Thin client for the join server (see server.py). Kept free of heavy imports
+# so that sending a request is cheap.
+
+def request(socketPath, args):
+    # Send args to the server and copy its output to stdout and stderr.
+    # Returns the exit status, or None if no server is listening.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock:
+        req = {k: v for k, v in vars(args).items() if k not in ['socket', 'serve']}
+        req['cwd'] = os.getcwd()
+        sock.sendall(json.dumps(req).encode() + b'\n')
+        reply = sock.makefile('rb')
+        header = json.loads(reply.readline())
+        sys.stderr.write(header['stderr'])
+        remaining = header['length']
+        while remaining:
+            data = reply.read(min(remaining, 1024*1024))
+            if not data:
+                break # server went away
+            sys.stdout.buffer.write(data)
+            remaining -= len(data)
+        return header['status']
@@ -5,6 +5,7 @@
 # the point where arguments are parsed. Want minimal code before this point.
 
 import argparse
+import os
 
 try:
     import argcomplete
@@ -13,7 +14,7 @@ except ImportError:
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument("files", nargs='+', help="path to input files")
+parser.add_argument("files", nargs='*', help="path to input files")
 
 breaks = parser.add_mutually_exclusive_group()
 breaks.add_argument("-l", "--line-breaks", action="store_true", help="add line breaks between scores (can't be used with -p)")
@@ -23,59 +24,83 @@ parser.add_argument("-s", "--section-breaks", action="store_true", help="add sec
 parser.add_argument("-c", "--cover", type=str, action="append", help="insert frames from score file")
 parser.add_argument("-d", "--dictionary", type=str, action="append", help="path to YAML (.yml) file with variable substitutions")
 
-parser.add_argument("-t", "--template", action="store_true", help="fix instrument names in a template score")
-
-
-try:
-    argcomplete.autocomplete(parser)
-except NameError:
-    pass # no bash completion :(
-
-args = parser.parse_args()
-
-# argcomplete has exited by this point, so here comes the actual program code.
-
-import recipe
-import score
-import sys
-import yaml
-
-if args.files[0].endswith(".yml"):
-    r = recipe.Recipe(yaml.safe_load(open(args.files[0])))
-    r.run()
-    exit()
-
-firstScore = score.ScoreFile(args.files.pop(0))
-
-if args.template:
-    firstScore.fix_instrument_names()
-    firstScore.writeToFile(sys.stdout.buffer)
-    exit()
-
-dictionary = {}
-if args.dictionary:
-    for path in args.dictionary:
-        d = yaml.safe_load(open(path))
-        dictionary.update(d)
-    score_id = dictionary['id']['musescore']
-    if isinstance(score_id, int) or score_id.isdigit():
-        score_url = "https://musescore.com/score/{0}".format(score_id)
-    else:
-        score_url = ""
-    firstScore['source'] = score_url
-
-if args.cover:
-    firstScore['movementNumber'] = ""
-    firstScore['movementTitle'] = ""
-    firstScore.set_style('footerFirstPage', '0')
-    firstScore.score.find('showInvisible').text = '0'
-    firstScore.score.find('showUnprintable').text = '0'
-    firstScore.score.find('showFrames').text = '0'
-    firstScore.score.find('showMargins').text = '0'
-    for cover in reversed(args.cover):
-        firstScore.prepend_cover(score.ScoreFile(cover, dictionary))
-
-for file in args.files:
-    firstScore.append_score(score.ScoreFile(file), args.line_breaks, args.page_breaks, args.section_breaks)
-
-firstScore.writeToFile(sys.stdout.buffer)
+parser.add_argument("-t", "--template", action="store_true", help="fix instrument names in a template score (or in every template in the given files and directories, see -o and --in-place)")
+parser.add_argument("--in-place", action="store_true", help="with -t, overwrite each template with the fixed one")
+parser.add_argument("-V", "--variant", type=str, action="append", metavar="'OUTPUT [-l|-p] [-s] [-c COVER]...'", help="write the join to OUTPUT with these options instead of to stdout (repeat for each variant; the scores are parsed only once for all of them)")
+parser.add_argument("--multimeasure-rests", action="store_true", help="show runs of empty measures (e.g. in parts missing from some scores) as multi-measure rests")
+parser.add_argument("--raw", action="store_true", help="copy staff contents as raw bytes, shifting only IDs, measure numbers and ticks, if all scores have the same parts and staves")
+parser.add_argument("--plan", action="store_true", help="print what the join would do (staff matching, filler and offsets) as JSON without joining, scanning only what is needed; exits 1 if it can't be done")
+parser.add_argument("--stream", action="store_true", help="keep only one input score in memory at a time")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="parse and append input scores in JOBS parallel processes (not with --variant)")
+parser.add_argument("--cache-dir", type=str, help="reuse parsed input scores and compiled cover templates stored in this directory")
+parser.add_argument("-o", "--output-dir", type=str, help="build each recipe (.yml file or directory of them) to its own file in this directory, or with -t write the fixed templates here")
+parser.add_argument("--cache-size", type=int, default=512, help="maximum size of the cache in MB (default 512)")
+parser.add_argument("-z", "--mscz", action="store_true", help="write compressed .mscz instead of .mscx")
+parser.add_argument("--compression-level", type=int, default=6, help="zip compression level (0-9) for .mscz output (default 6)")
+parser.add_argument("--timings", "--profile", type=str, metavar="FILE", help="write the time of each phase for each input file to FILE as JSON")
+parser.add_argument("--trace-memory", action="store_true", help="with --timings, also record the peak memory each phase allocates (makes the join several times slower)")
+parser.add_argument("-w", "--watch", action="store_true", help="rebuild a recipe's output file (see -o) whenever any file it uses changes")
+parser.add_argument("--socket", type=str, default=os.environ.get("MSCORE_JOIN_SOCKET"), help="send the job to the server listening on this Unix socket if there is one (default $MSCORE_JOIN_SOCKET)")
+parser.add_argument("--serve", action="store_true", help="run a server on --socket that keeps parsed scores and templates in memory between jobs")
+
+
+def main():
+    # Worker processes import this file as a module with the start methods
+    # that don't fork (spawn, the default on macOS and Windows, and
+    # forkserver), so nothing runs unless it is the main program.
+    try:
+        argcomplete.autocomplete(parser)
+    except NameError:
+        pass # no bash completion :(
+
+    args = parser.parse_args()
+
+    # argcomplete has exited by this point, so here comes the actual program code.
+
+    import sys
+
+    if args.serve:
+        if not args.socket:
+            parser.error("--serve requires --socket")
+        import server
+        server.serve(args.socket, args)
+        exit()
+
+    if not args.files:
+        parser.error("the following arguments are required: files")
+
+    if args.watch and (len(args.files) != 1 or not args.files[0].endswith(".yml")):
+        parser.error("--watch requires a single recipe")
+
+    if args.variant and (args.files[0].endswith(".yml") or args.line_breaks or args.page_breaks or args.section_breaks
+                         or args.cover or args.template or args.stream or args.raw or args.output_dir or args.watch):
+        parser.error("--variant is for joining score files, with breaks and covers given for each variant")
+
+    if args.in_place and (not args.template or args.output_dir):
+        parser.error("--in-place is for -t without -o")
+
+    if args.in_place and args.mscz:
+        parser.error("--in-place keeps the format of each template, so can't be used with -z")
+
+    if args.template and not (args.output_dir or args.in_place) and (len(args.files) > 1 or os.path.isdir(args.files[0])):
+        parser.error("-t with several templates writes them to -o or over themselves with --in-place")
+
+    if args.plan and (args.template or args.variant or args.stream or args.raw or args.output_dir or args.watch):
+        parser.error("--plan can't be used with -t, --variant, --stream, --raw, -o or -w")
+
+    if args.trace_memory and not args.timings:
+        parser.error("--trace-memory is for --timings")
+
+    if args.socket and not args.watch:
+        import client
+        status = client.request(args.socket, args)
+        if status is not None:
+            exit(status)
+        # no server running so do the work here
+
+    import cli
+
+    exit(cli.run(args, sys.stdout.buffer, cli.open_cache(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import functools
+import io
+import multiprocessing
+import plan
+import rawjoin
+import score
+import timings
+import xmlbackend
+
+# Join scores with most of the work done in parallel. ScoreJoin appends
+# scores one at a time, as the element IDs, measure numbers and ticks of each
+# score are shifted by the totals of the scores before it. But those totals
+# only depend on the maximum ID, maximum measure number and duration of each
+# score, which plan.scan finds without building trees, so the offsets of
+# every score can be worked out up front (see plan.offsets). Then each score
+# is parsed, shifted, matched to the staves of the first score and given
+# filler in a worker process, which serializes what it adds to each staff.
+# As the offsets are already right, merging the results is just writing
+# each staff's pieces out in order, which the parent process does with
+# StreamingScoreJoin's spools while the workers carry on.
+
+def _scan_stats(filePath):
+    return plan.scan(filePath).stats
+
+def _append(task, cache=None):
+    # worker: returns the serialized contents that the score adds to each
+    # staff of the first score, and its stats and timeline after shifting
+    firstPath, filePath, offsets, breaks = task
+    index = plan.scan(firstPath).index
+    if cache is None:
+        scoreFile = score.ScoreFile(filePath)
+    else:
+        cached = cache.load(filePath)
+        if cached.raw:
+            rawScore = cached.raw_score(filePath)
+            if rawScore.can_append_to(index):
+                return _append_raw(rawScore, cached, offsets, breaks)
+        scoreFile = cached.scoreFile(filePath)
+    with timings.phase('offsets', filePath):
+        stats = scoreFile.normalize_and_shift(*offsets)
+
+    staves = [score.ET.Element('Staff') for staff in index.staves]
+    joinPlan = []
+    for match in score.match_staves(index, scoreFile.index, filePath):
+        joinPlan.append(score.JoinStep(match.action, match.s_idx1, staves[match.s_idx1],
+                                       scoreFile.staff(match.s_idx2)))
+    score.do_join_plan(joinPlan, filePath)
+
+    # the layout breaks before the next score go on this one's final measure
+    for element in reversed(staves[0]):
+        if element.tag == 'Measure':
+            for type in breaks:
+                score.appendLayoutBreak(element, type)
+            break
+
+    with timings.phase('serialize', filePath):
+        contents = [b''.join(xmlbackend.tostring(child) for child in staff) for staff in staves]
+    records = timings.take() if timings.enabled() else None
+    return contents, stats, scoreFile.timeline, records
+
+def _append_raw(rawScore, cached, offsets, breaks):
+    # as _append, for a cached score that can be appended as bytes (see
+    # cache.CachedScoreJoin)
+    shifts = rawjoin.shift(*offsets)
+    with timings.phase('append', rawScore.filePath):
+        files = [io.BytesIO() for staff in rawScore.staves]
+        rawScore.append_staves(files, shifts)
+        for type in breaks:
+            rawScore.appendLayoutBreak(type)
+        rawScore.append_final(files[0], shifts)
+    stats = cached.shifted_stats(offsets[0], offsets[1])
+    records = timings.take() if timings.enabled() else None
+    return [f.getvalue() for f in files], stats, cached.timeline, records
+
+class ParallelScoreJoin(score.StreamingScoreJoin):
+    # StreamingScoreJoin that appends a list of score files using `jobs`
+    # worker processes. The output is the same as appending them one by one.
+    def append_files(self, filePaths, addLineBreak, addPageBreak, addSectionBreak, jobs, cache=None):
+        # Must be the last thing appended, as the final measure is written
+        # out and so can't take layout breaks for another score.
+        if not filePaths:
+            return
+        breaks = score.layout_break_types(addLineBreak, addPageBreak, addSectionBreak)
+        with multiprocessing.Pool(jobs, timings.start_worker, (timings.worker_settings(),)) as pool:
+            stats = pool.map(_scan_stats, filePaths)
+            totals = (self.maxElementID, self.maxMeasureNumber, self.ticks)
+            shifts, expected = plan.offsets(totals, stats, addSectionBreak)
+
+            self.add_layout_breaks(addLineBreak, addPageBreak, addSectionBreak)
+            self.flush(keepFinalMeasure=False)
+            tasks = []
+            for idx, (filePath, offsets) in enumerate(zip(filePaths, shifts)):
+                last = idx == len(filePaths) - 1
+                tasks.append((self.scoreFile.filePath, filePath, offsets, [] if last else breaks))
+            for contents, stats, timeline, records in pool.imap(functools.partial(_append, cache=cache), tasks):
+                if records:
+                    timings.extend(records)
+                for spool, data in zip(self.spools, contents):
+                    spool.write(data)
+                self.add_stats(stats, timeline)
+        # the offsets came from scans, so check they agree with the parses
+        assert((self.maxElementID, self.maxMeasureNumber, self.ticks) == expected)
@@ -0,0 +1,117 @@
+import collections
+import functools
+import os
+import rawjoin
+import score
+
+# Work out what a join would do without doing it: which staff of each score
+# is appended to which staff of the first score, which staves get filler
+# measures instead, and the offsets added to the element IDs, measure
+# numbers and ticks of each score. Scores are scanned with rawjoin.RawScore,
+# which indexes the staves without building element trees, so checking the
+# plan of a join takes a fraction of the time of the join itself. Scores
+# that RawScore can't index are parsed as usual.
+
+# What a join needs to know about a score
+Scan = collections.namedtuple('Scan', ['index', 'stats', 'measures'])
+
+def _modified(filePath):
+    # cache key for a file, so changed files are scanned again (e.g. when
+    # planning in the join server)
+    stat = os.stat(filePath)
+    return filePath, stat.st_mtime_ns, stat.st_size
+
+def scan(filePath):
+    return _scan(*_modified(filePath))
+
+@functools.lru_cache(maxsize=1024) # scores are often shared between recipes
+def _scan(filePath, mtime, size):
+    try:
+        raw = rawjoin.RawScore(filePath)
+        return Scan(raw.index, raw.stats(0, 0), len(raw.timeline))
+    except rawjoin.NotRaw:
+        scoreFile = score.ScoreFile(filePath)
+        return Scan(scoreFile.index, scoreFile.stats(), len(scoreFile.timeline))
+
+def scan_cover(filePath):
+    # highest element ID in the frames that ScoreFile.prepend_cover takes
+    # from a cover, as they come before the IDs of the appended scores
+    return _scan_cover(*_modified(filePath))
+
+@functools.lru_cache(maxsize=1024)
+def _scan_cover(filePath, mtime, size):
+    maxElementID = 0
+    for frame in reversed(score.ScoreFile(filePath).firstStaff()[:]):
+        if frame.tag == "Measure":
+            break
+        for element in frame.iter():
+            if element.get('id') is not None:
+                maxElementID = max(maxElementID, int(element.get('id')))
+    return maxElementID
+
+def offsets(totals, stats, addSectionBreak):
+    # The (element ID, measure number, tick) offsets that ScoreJoin shifts
+    # scores by when appending them in turn to a join with running totals
+    # `totals`, given the ScoreStats of the unshifted scores. Each score's
+    # offsets are prefix sums (or maximums) of the stats of those before it,
+    # so they are known before any score is shifted. Returns the offsets of
+    # each score and the totals after them all.
+    maxElementID, maxMeasureNumber, ticks = totals
+    shifts = []
+    for s in stats:
+        measureOffset = 0 if addSectionBreak else maxMeasureNumber
+        shifts.append((maxElementID, measureOffset, ticks))
+        # as ScoreJoin.add_stats, but with the stats of the unshifted score
+        maxElementID = max(maxElementID, s.maxElementID + maxElementID)
+        maxMeasureNumber = max(maxMeasureNumber, s.maxMeasureNumber + measureOffset)
+        ticks += s.ticks
+    return shifts, score.ScoreStats(maxElementID, maxMeasureNumber, ticks)
+
+def _no_log(*args):
+    pass
+
+def _ticks(ticks):
+    # durations are Fractions; JSON has whole numbers (or strings)
+    return int(ticks) if ticks == int(ticks) else str(ticks)
+
+def plan(filePaths, addLineBreak, addPageBreak, addSectionBreak, covers=()):
+    # Returns the plan of joining filePaths as a dict for writing as JSON.
+    # Problems that would stop the join are listed in its "errors".
+    errors = []
+    scans = []
+    for filePath in filePaths:
+        try:
+            scans.append((filePath, scan(filePath)))
+        except (OSError, score.ET.ParseError) as e:
+            errors.append("%s: %s" % (filePath, e))
+    coverMaxElementID = 0
+    for cover in covers:
+        try:
+            coverMaxElementID = max(coverMaxElementID, scan_cover(cover))
+        except (OSError, score.ET.ParseError) as e:
+            errors.append("%s: %s" % (cover, e))
+    result = {"covers": list(covers), "scores": [], "errors": errors}
+    if not filePaths:
+        errors.append("No scores!")
+    if not scans or scans[0][0] != filePaths[0]:
+        return result # nothing to join onto
+
+    firstPath, first = scans[0]
+    totals = first.stats._replace(maxElementID=max(first.stats.maxElementID, coverMaxElementID))
+    result["staves"] = len(first.index.staves)
+    result["scores"].append({"file": firstPath, "measures": first.measures, "ticks": _ticks(first.stats.ticks),
+                             "offsets": {"id": 0, "measure": 0, "tick": 0}})
+
+    breaks = score.layout_break_types(addLineBreak, addPageBreak, addSectionBreak)
+    shifts, totals = offsets(totals, [s.stats for filePath, s in scans[1:]], addSectionBreak)
+    for (filePath, s), (idOffset, measureOffset, tickOffset) in zip(scans[1:], shifts):
+        staves = []
+        for match in score.match_staves(first.index, s.index, filePath, errors, log=_no_log):
+            staves.append({"staff": match.s_idx1 + 1, "action": match.action, "from": match.s_idx2 + 1})
+        result["scores"].append({"file": filePath, "measures": s.measures, "ticks": _ticks(s.stats.ticks),
+                                 "breaks": breaks, "staves": staves,
+                                 "offsets": {"id": idOffset, "measure": measureOffset, "tick": _ticks(tickOffset)}})
+
+    result["total"] = {"maxElementID": totals.maxElementID, "maxMeasureNumber": totals.maxMeasureNumber,
+                       "ticks": _ticks(totals.ticks), "measures": sum(s.measures for filePath, s in scans)}
+    return result
@@ -0,0 +1,414 @@
+import array
+import bisect
+import fractions
+import mmap
+import re
+import score
+import timings
+import xmlbackend
+
+# Join scores without building element trees for the staves. When every
+# score has the same parts and staves, appending a score only means copying
+# the contents of each of its staves to the end of the same staff in the
+# output, with element IDs, measure numbers and ticks shifted. So each input
+# is indexed once for the byte ranges of its staves and of the numbers in
+# them, and the output is spliced together from slices of the (memory
+# mapped) inputs with only those numbers rewritten. The few elements that
+# the tree join inserts (key signatures, final barlines, layout breaks) are
+# inserted as bytes in the same places.
+#
+# The output matches the tree join element for element, but keeps the input
+# formatting (e.g. "<tag/>" rather than "<tag />"). Anything else, like
+# filler for missing parts or covers, needs the tree join: RawScore and
+# RawScoreJoin raise NotRaw for scores they can't handle. RawScore is also
+# used on its own to scan scores quickly (see plan.py), and to append scores
+# from a score cache as bytes (see cache.CachedScoreJoin).
+
+class NotRaw(Exception):
+    pass
+
+# Numbers that are shifted when a score is appended, by kind:
+ID = ord('I')       # id="..." attribute of any element
+NUMBER = ord('N')   # number="..." attribute of a Measure
+TICK = ord('T')     # <tick> text
+BEAM = ord('B')     # <Beam> or <Tuplet> text (refers to an ID)
+
+TOKENS = re.compile(rb'<(Beam|Tuplet)>(-?\d+)</\1>'
+                    rb'|<tick>(-?\d+)</tick>'
+                    rb'|<Measure(\s[^<>]*)?>'
+                    rb'|<[\w.:-]+\s(?:[^<>]*?\s)?id="(-?\d+)"')
+MEASURE_ATTRIBUTES = re.compile(rb'\s(id|number|len)="([^"]*)"')
+NESTED_SCORE = re.compile(rb'<Score[\s>]')
+STAFF_ID = re.compile(rb'<Staff id="(\d+)">')
+TIME_SIG_OR_NOTES = re.compile(rb'<(TimeSig|Chord|Rest)[\s>]|</voice>')
+SIG_N = re.compile(rb'<sigN>(\d+)</sigN>')
+SIG_D = re.compile(rb'<sigD>(\d+)</sigD>')
+
+KEYSIG = b'<KeySig><accidental>0</accidental></KeySig>\n          '
+BARLINE = b'<BarLine><subtype>end</subtype></BarLine>\n          '
+VOICE_WITH_BARLINE = b'<voice>' + BARLINE + b'</voice>'
+
+def shift(idOffset, measureOffset, tickOffset):
+    # offsets by kind for write_staff
+    return {ID: idOffset, BEAM: idOffset, NUMBER: measureOffset, TICK: tickOffset}
+
+def layout_break(type):
+    return b'<LayoutBreak><subtype>' + type.encode() + b'</subtype></LayoutBreak>'
+
+class RawStaff:
+    # Byte ranges of a top-level <Staff> in a score, and the numbers in it.
+    def __init__(self, id, start, contentStart, close):
+        self.id = id
+        self.start = start               # <Staff id="...">
+        self.contentStart = contentStart # first child (after leading whitespace)
+        self.close = close               # </Staff>
+        self.tokenStarts = array.array('q')
+        self.tokenEnds = array.array('q')
+        self.tokenValues = array.array('q')
+        self.tokenKinds = bytearray()
+        self.measures = []               # (start, end) of each Measure
+        self.measureLengths = []         # len attribute of each Measure, or None
+        self.inserts = []                # (position, bytes) added by the join
+
+    def add_token(self, kind, start, end, value):
+        self.tokenKinds.append(kind)
+        self.tokenStarts.append(start)
+        self.tokenEnds.append(end)
+        self.tokenValues.append(int(value))
+
+    def max_value(self, kinds):
+        values = [v for k, v in zip(self.tokenKinds, self.tokenValues) if k in kinds]
+        return max(values) if values else None
+
+class RawScore:
+    # A score file (or its contents, as data) indexed for RawScoreJoin.
+    # Raises NotRaw if the file has anything that the index doesn't cover.
+    def __init__(self, filePath, data=None):
+        self.filePath = filePath
+        with timings.phase('index', filePath):
+            self.data = self._read(filePath) if data is None else data
+            self._index_header()
+            self._index_staves()
+
+    def _read(self, filePath):
+        if score.is_mscz(filePath):
+            with score.open_mscz(filePath) as f:
+                return f.read()
+        with open(filePath, 'rb') as f:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise NotRaw("%s is empty" % filePath)
+
+    def _index_header(self):
+        data = self.data
+        declaration = data[:data.find(b'?>') + 2] if data[:5] == b'<?xml' else b''
+        if b'encoding' in declaration and not re.search(rb'encoding=["\']UTF-8["\']', declaration, re.I):
+            raise NotRaw("%s is not UTF-8" % self.filePath)
+        if data.find(b'<!', len(declaration)) != -1 or data.find(b'<?', len(declaration)) != -1:
+            raise NotRaw("%s has comments, CDATA or declarations" % self.filePath)
+        scoreStart = data.find(b'<Score>')
+        if scoreStart == -1:
+            raise NotRaw("%s has no score" % self.filePath)
+        # parts (excerpts) are nested scores after the staves of the main score
+        nested = NESTED_SCORE.search(data, scoreStart + 1)
+        self.scoreEnd = nested.start() if nested else data.rfind(b'</Score>')
+        lastPart = data.rfind(b'</Part>', 0, self.scoreEnd)
+        self.headerEnd = data.find(b'<Staff ', lastPart, self.scoreEnd)
+        if lastPart == -1 or self.headerEnd == -1:
+            raise NotRaw("%s has no parts or staves" % self.filePath)
+        # parse everything before the staves to compare parts and staff
+        # definitions with the other scores
+        self.root = xmlbackend.fromstring(data[:self.headerEnd] + b'</Score></museScore>')
+        if float(self.root.get('version', 0)) < 3:
+            raise NotRaw("%s is older than MuseScore 3" % self.filePath)
+        self.division = int(self.root.find('Score/Division').text)
+
+    def _index_staves(self):
+        data = self.data
+        self.staves = []
+        pos = self.headerEnd
+        while pos != -1:
+            match = STAFF_ID.match(data, pos)
+            if not match:
+                raise NotRaw("%s has an unexpected Staff tag" % self.filePath)
+            close = data.find(b'</Staff>', match.end())
+            contentStart = match.end()
+            while data[contentStart:contentStart + 1].isspace():
+                contentStart += 1
+            staff = RawStaff(match.group(1).decode(), pos, contentStart, close)
+            self._index_staff(staff)
+            self.staves.append(staff)
+            pos = data.find(b'<Staff ', close, self.scoreEnd)
+            if pos != -1 and data[close + len(b'</Staff>'):pos].strip():
+                raise NotRaw("%s has elements between staves" % self.filePath)
+
+        # index the parts with an empty element for each staff, so it's like
+        # the index of the whole score
+        header = self.root.find('Score')
+        for staff in self.staves:
+            score.ET.SubElement(header, 'Staff', id=staff.id)
+        self.index = score.StaffIndex(header)
+        ids = [str(idx + 1) for idx in range(len(self.staves))]
+        if [staff.id for staff in self.staves] != ids or list(self.index.staff_def) != ids:
+            raise NotRaw("%s has staves out of order" % self.filePath)
+
+        # durations come from the first staff, as in ScoreFile.timeline
+        self.timeline = score.MeasureTimeline(self.division * 4)
+        for (start, end), length in zip(self.staves[0].measures, self.staves[0].measureLengths):
+            timeSig = self._time_sig(start, end) or self.timeline.current_time_sig()
+            joinLength = fractions.Fraction(length.decode()) if length else self.timeline.joinTimeSig
+            self.timeline.add(fractions.Fraction(length.decode()) if length else timeSig, timeSig, joinLength)
+
+    def _index_staff(self, staff):
+        data = self.data
+        if data.find(b'<Measure/>', staff.contentStart, staff.close) != -1:
+            raise NotRaw("%s has an empty measure" % self.filePath)
+        for match in TOKENS.finditer(data, staff.contentStart, staff.close):
+            if match.group(2) is not None:
+                staff.add_token(BEAM, match.start(2), match.end(2), match.group(2))
+            elif match.group(3) is not None:
+                staff.add_token(TICK, match.start(3), match.end(3), match.group(3))
+            elif match.group(5) is not None:
+                staff.add_token(ID, match.start(5), match.end(5), match.group(5))
+            else:
+                attributes = match.group(4) or b''
+                if attributes.endswith(b'/'):
+                    raise NotRaw("%s has an empty measure" % self.filePath)
+                length = None
+                for attribute in MEASURE_ATTRIBUTES.finditer(attributes):
+                    name, value = attribute.group(1), attribute.group(2)
+                    start = match.start(4) + attribute.start(2)
+                    if name == b'len':
+                        length = value
+                    elif value.lstrip(b'-').isdigit():
+                        staff.add_token(ID if name == b'id' else NUMBER, start, start + len(value), value)
+                end = data.find(b'</Measure>', match.end(), staff.close)
+                if end == -1:
+                    raise NotRaw("%s has an unclosed measure" % self.filePath)
+                staff.measures.append((match.start(), end))
+                staff.measureLengths.append(length)
+
+    def _time_sig(self, start, end):
+        # as score.measure_time_sig, for the measure at data[start:end]
+        match = TIME_SIG_OR_NOTES.search(self.data, start, end)
+        if not match or match.group(1) != b'TimeSig':
+            return None
+        timeSigEnd = self.data.find(b'</TimeSig>', match.end(), end)
+        n = SIG_N.search(self.data, match.end(), timeSigEnd)
+        d = SIG_D.search(self.data, match.end(), timeSigEnd)
+        return fractions.Fraction(int(n.group(1)), int(d.group(1)))
+
+    def _measure(self, start, end):
+        # parse one measure, to decide what the tree join would insert in it
+        return xmlbackend.fromstring(self.data[start:end + len(b'</Measure>')])
+
+    def explicitCMajorKeySig(self):
+        # as score.explicitCMajorKeySig, for every staff
+        for staff in self.staves:
+            if not staff.measures:
+                continue
+            start, end = staff.measures[0]
+            voice = self._measure(start, end).find('voice')
+            if voice is None:
+                continue
+            for element in voice:
+                if element.tag == 'KeySig':
+                    break
+                if element.tag in ['Chord', 'Rest']:
+                    position = self.data.find(b'<voice>', start, end)
+                    if position == -1 or (voice.text or '').strip():
+                        raise NotRaw("%s has an unexpected voice" % self.filePath)
+                    position += len(b'<voice>') + len((voice.text or '').encode())
+                    staff.inserts.append((position, KEYSIG))
+                    break
+
+    def explicitFinalBarline(self):
+        # as score.explicitFinalBarline, for every staff
+        for staff in self.staves:
+            if not staff.measures:
+                continue
+            start, end = staff.measures[-1]
+            voice = self._measure(start, end).find('voice')
+            if voice is None:
+                staff.inserts.append((end, VOICE_WITH_BARLINE))
+            elif len(voice) == 0 or voice[-1].tag != 'BarLine':
+                position = self.data.find(b'</voice>', start, end)
+                if position == -1:
+                    raise NotRaw("%s has an empty voice" % self.filePath)
+                staff.inserts.append((position, BARLINE))
+
+    def appendLayoutBreak(self, type):
+        # returns False if the first staff has no measures
+        staff = self.staves[0]
+        if not staff.measures:
+            return False
+        staff.inserts.append((staff.measures[-1][1], layout_break(type)))
+        return True
+
+    def stats(self, idOffset, measureOffset):
+        # ScoreStats after shifting, as score.ScoreFile.normalize_and_shift
+        maxID = max((v for v in (staff.max_value((ID,)) for staff in self.staves) if v is not None), default=None)
+        maxNumber = max((v for v in (staff.max_value((NUMBER,)) for staff in self.staves) if v is not None), default=None)
+        return score.ScoreStats(0 if maxID is None else maxID + idOffset,
+                                0 if maxNumber is None else maxNumber + measureOffset,
+                                self.timeline.ticks)
+
+    def write_staff(self, file, idx, start, end, offsets):
+        # write bytes start to end of staff idx, with the numbers shifted by
+        # offsets (by kind) and the join's insertions
+        staff = self.staves[idx]
+        data = self.data
+        inserts = sorted((insert for insert in staff.inserts if start <= insert[0] < end),
+                         key=lambda insert: insert[0]) # stable
+        lo = bisect.bisect_left(staff.tokenStarts, start)
+        hi = bisect.bisect_left(staff.tokenStarts, end)
+        tokens = zip(staff.tokenKinds[lo:hi], staff.tokenStarts[lo:hi], staff.tokenEnds[lo:hi], staff.tokenValues[lo:hi])
+        pieces = []
+        last = start
+        i = 0
+        for kind, tokenStart, tokenEnd, value in tokens:
+            offset = offsets.get(kind)
+            if not offset:
+                continue
+            while i < len(inserts) and inserts[i][0] <= tokenStart:
+                pieces.append(data[last:inserts[i][0]])
+                pieces.append(inserts[i][1])
+                last = inserts[i][0]
+                i += 1
+            pieces.append(data[last:tokenStart])
+            pieces.append(str(value + offset).encode())
+            last = tokenEnd
+        for position, text in inserts[i:]:
+            pieces.append(data[last:position])
+            pieces.append(text)
+            last = position
+        pieces.append(data[last:end])
+        file.writelines(pieces)
+
+    def can_append_to(self, index):
+        # True if append_staves can append this score to one with StaffIndex
+        # index (so with no filler, which needs trees)
+        return bool(self.staves[0].measures) and same_parts(index, self.index)
+
+    def append_staves(self, files, offsets):
+        # Write the contents of each staff to the file for it in files, with
+        # the numbers shifted by offsets, except for the final measure of the
+        # first staff, which append_final writes after any layout breaks have
+        # been added to it.
+        for idx, (file, staff) in enumerate(zip(files, self.staves)):
+            end = staff.measures[-1][0] if idx == 0 else staff.close
+            self.write_staff(file, idx, staff.contentStart, end, offsets)
+
+    def append_final(self, file, offsets):
+        staff = self.staves[0]
+        self.write_staff(file, 0, staff.measures[-1][0], staff.close, offsets)
+
+def _tree_numbers(staff):
+    # the numbers that score.ScoreFile.normalize_and_shift shifts in a
+    # staff, by kind, as in the XML
+    numbers = {ID: [], NUMBER: [], TICK: [], BEAM: []}
+    for child in staff:
+        for element in child.iter():
+            ID_ = element.get('id')
+            if ID_ is not None:
+                numbers[ID].append(ID_)
+            tag = element.tag
+            if tag == 'Measure':
+                if element.get('number') is not None:
+                    numbers[NUMBER].append(element.get('number'))
+            elif tag == 'tick':
+                numbers[TICK].append(element.text)
+            elif tag in ['Beam', 'Tuplet']:
+                try:
+                    int(element.text)
+                except (TypeError, ValueError):
+                    continue # had an ID, not a number
+                numbers[BEAM].append(element.text)
+    return numbers
+
+def same_numbers(rawScore, scoreFile):
+    # True if rawScore, indexed from the serialized scoreFile, has exactly
+    # the numbers that the tree join would shift, each written as the tree
+    # join would write it after shifting by zero. Then write_staff gives the
+    # same bytes as shifting the tree and serializing it.
+    if len(rawScore.staves) != len(scoreFile.staves):
+        return False
+    for rawStaff, staff in zip(rawScore.staves, scoreFile.staves):
+        if (staff.text or '').strip():
+            return False
+        numbers = _tree_numbers(staff)
+        for kind, values in numbers.items():
+            for value in values:
+                try:
+                    if str(int(value)) != value:
+                        return False
+                except (TypeError, ValueError):
+                    return False
+        found = {ID: [], NUMBER: [], TICK: [], BEAM: []}
+        data = rawScore.data
+        for kind, start, end in zip(rawStaff.tokenKinds, rawStaff.tokenStarts, rawStaff.tokenEnds):
+            found[kind].append(data[start:end].decode())
+        if found != numbers:
+            return False
+    return True
+
+def same_parts(index1, index2):
+    # True if joining would append every staff, with no filler
+    if index1.staff_ids_for_part != index2.staff_ids_for_part:
+        return False
+    for part1, part2 in zip(index1.parts, index2.parts):
+        for tag in ["longName", "shortName", "trackName", "instrumentId"]:
+            if part1.findtext("Instrument/" + tag) != part2.findtext("Instrument/" + tag):
+                return False
+    return all(index1.same_staff_def(id, index2, id) for id in index1.staff_def)
+
+class RawScoreJoin:
+    # Like score.ScoreJoin, for RawScores.
+    def __init__(self, rawScore):
+        self.scoreFile = rawScore
+        rawScore.explicitFinalBarline()
+        self.maxElementID, self.maxMeasureNumber, self.ticks = rawScore.stats(0, 0)
+        self.lastWithMeasures = rawScore if rawScore.staves[0].measures else None
+        self.appended = [] # (rawScore, offsets)
+
+    def append_score(self, rawScore, addLineBreak, addPageBreak, addSectionBreak):
+        if not same_parts(self.scoreFile.index, rawScore.index):
+            raise NotRaw("%s has different parts or staves" % rawScore.filePath)
+        if self.lastWithMeasures is not None:
+            if addPageBreak:
+                self.lastWithMeasures.appendLayoutBreak('page')
+            elif addLineBreak:
+                self.lastWithMeasures.appendLayoutBreak('line')
+            if addSectionBreak:
+                self.lastWithMeasures.appendLayoutBreak('section')
+
+        measureOffset = 0 if addSectionBreak else self.maxMeasureNumber
+        rawScore.explicitCMajorKeySig()
+        rawScore.explicitFinalBarline()
+        stats = rawScore.stats(self.maxElementID, measureOffset)
+        self.appended.append((rawScore, shift(self.maxElementID, measureOffset, self.ticks)))
+        self.maxElementID = max(self.maxElementID, stats.maxElementID)
+        self.maxMeasureNumber = max(self.maxMeasureNumber, stats.maxMeasureNumber)
+        self.ticks += stats.ticks
+        if rawScore.staves[0].measures:
+            self.lastWithMeasures = rawScore
+
+    def writeToFile(self, file):
+        with timings.phase('serialize', self.scoreFile.filePath):
+            first = self.scoreFile
+            file.write(first.data[:first.headerEnd])
+            for idx, staff in enumerate(first.staves):
+                first.write_staff(file, idx, staff.start, staff.close, {})
+                for rawScore, offsets in self.appended:
+                    other = rawScore.staves[idx]
+                    rawScore.write_staff(file, idx, other.contentStart, other.close, offsets)
+                nextStaff = first.staves[idx + 1].start if idx + 1 < len(first.staves) else len(first.data)
+                file.write(first.data[staff.close:nextStaff])
+
+def join(filePaths, addLineBreak, addPageBreak, addSectionBreak):
+    # Returns a RawScoreJoin of the files, or raises NotRaw.
+    join = RawScoreJoin(RawScore(filePaths[0]))
+    for filePath in filePaths[1:]:
+        join.append_score(RawScore(filePath), addLineBreak, addPageBreak, addSectionBreak)
+    return join
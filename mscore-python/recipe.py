@@ -1,28 +1,45 @@
 import yaml
-import sys
+import os
+import cache
+import paralleljoin
+import plan
 import score
 
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
+def path(name):
+    # scores are named without extension, and may be .mscx or .mscz
+    if not os.path.exists(name + ".mscx") and os.path.exists(name + ".mscz"):
+        return name + ".mscz"
+    return name + ".mscx"
 
 class Recipe(dict):
     def __init__(self, *args, **kwargs):
         self.update(*args, **kwargs)
 
     def scores(self):
-        return [s['score'] + ".mscx" for s in self['structure'] if 'score' in s]
+        return [path(s['score']) for s in self['structure'] if 'score' in s]
 
     def covers(self):
         return [s['cover'] + ".mscx" for s in self['structure'] if 'cover' in s]
 
-    def run(self):
+    def plan(self):
+        # what join() would do, as a dict (see plan.py)
+        return plan.plan(self.scores(), False, True, True, self.covers())
+
+    def join(self, jobs=1, scoreCache=None):
         scores = self.scores()
-        if not scores:
-            eprint("No scores!")
-            exit(1)
         firstScore = score.ScoreFile(scores.pop(0))
         for cover in reversed(self.covers()):
             firstScore.prepend_cover(score.ScoreFile(cover, self))
-        for scorefile in scores:
-            firstScore.append_score(score.ScoreFile(scorefile), False, True, True)
-        firstScore.writeToFile(sys.stdout.buffer)
+        if jobs > 1:
+            join = paralleljoin.ParallelScoreJoin(firstScore)
+            join.append_files(scores, False, True, True, jobs, scoreCache)
+            return join
+        if scoreCache is not None:
+            join = cache.CachedScoreJoin(firstScore, scoreCache)
+            for filePath in scores:
+                join.append_file(filePath, False, True, True)
+            return join
+        join = score.ScoreJoin(firstScore)
+        for scorefile in score.load_scores(scores):
+            join.append_score(scorefile, False, True, True)
+        return join
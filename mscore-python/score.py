@@ -1,12 +1,21 @@
-import xml.etree.ElementTree as ET   # XML parser: <tag attrib="val">text</tag>
+import xmlbackend
+from xmlbackend import ET   # XML parser: <tag attrib="val">text</tag>
+import bisect
+import builtins
+import collections
+import copy
 import fractions
 import string
-#import jinja2
 import re
 import yaml
+import timings
 import sys
 import os
 import datetime
+import io
+import shutil
+import tempfile
+import zipfile
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -20,66 +29,595 @@ def fraction(timesig):
     t = tuple(timesig)
     return fractions.Fraction(t[0], t[1])
 
-def elements_equal(e1, e2):
-    if e1.tag != e2.tag: return False
-    if e1.text != e2.text: return False
-    if e1.tail != e2.tail: return False
-    if e1.attrib != e2.attrib: return False
-    if len(e1) != len(e2): return False
-    return all(elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
-
-def stave_defs_equal(sd1, sd2):
-    # IDs are allowed to differ but all else must be equal
-    saveID = sd1.get('id')
-    sd1.set('id', sd2.get('id'))
-    result = elements_equal(sd1, sd2)
-    sd1.set('id', saveID)
-    return result
+def measure_length(measure, currTimeSig):
+    # returns the measure's length and the time signature in effect after it
+    for element in measure:
+        if element.tag == 'TimeSig':
+            currTimeSig = fraction(element)
+            break # TimeSig found, so stop looking
+        elif element.tag in ['Note', 'Rest']:
+            break # ignore possible courtesy TimeSig at end of measure.
+    length = measure.get('len')
+    if length: # anacrusis/irregular measure
+        return fractions.Fraction(length), currTimeSig
+    return currTimeSig, currTimeSig # normal measure
+
+def measure_time_sig(measure):
+    # returns the time signature at the start of the measure, or None. It is
+    # in the measure in MuseScore 2 and in its first voice in MuseScore 3.
+    for element in measure:
+        if element.tag == 'TimeSig':
+            return fraction(element)
+        elif element.tag == 'voice':
+            for voiceElement in element:
+                if voiceElement.tag == 'TimeSig':
+                    return fraction(voiceElement)
+                elif voiceElement.tag in ['Chord', 'Rest']:
+                    break
+            return None
+        elif element.tag in ['Note', 'Rest']:
+            return None
+    return None
+
+def explicitCMajorKeySig(staff):
+    # insert a C Major key signature if no key is specified
+    firstMeasure = staff.find('Measure')
+    if firstMeasure is None:
+        return
+    firstVoice = firstMeasure.find('voice')
+    if firstVoice is None:
+        return
+    for element in firstVoice:
+        if element.tag == 'KeySig':
+            break # staff already has an explicit keysig
+        if element.tag in ['Chord', 'Rest']:
+            # no keysig before first Chord/Rest, so insert one now
+            keysig = ET.Element('KeySig')
+            keysig.tail = "\n          "
+            accidental = ET.SubElement(keysig, 'accidental')
+            accidental.text = "0" # C Major
+            firstVoice.insert(0, keysig)
+            break
+
+def explicitFinalBarline(finalMeasure):
+    # insert a final 'end' barline if no barline is specified
+    firstVoice = finalMeasure.find('voice')
+    if firstVoice is None:
+        firstVoice = ET.SubElement(finalMeasure, 'voice')
+    try:
+        lastElement = firstVoice[-1]
+        if lastElement.tag == 'BarLine':
+            return # already has explicit final barline (any kind)
+    except IndexError:
+        pass # voice is empty
+    barline = ET.SubElement(firstVoice, 'BarLine')
+    barline.tail = "\n          "
+    ET.SubElement(barline, 'subtype').text = 'end'
+
+def layout_break_types(addLineBreak, addPageBreak, addSectionBreak):
+    # the layout breaks to add between scores, in order
+    types = []
+    if addPageBreak:
+        types.append('page')
+    elif addLineBreak:
+        types.append('line')
+    if addSectionBreak:
+        types.append('section')
+    return types
+
+def appendLayoutBreak(measure, type): # line, page, section
+    layoutBreak = ET.Element('LayoutBreak')
+    subtype = ET.SubElement(layoutBreak, 'subtype')
+    subtype.text = type
+    measure.append(layoutBreak)
+    return layoutBreak
+
+# Compressed MuseScore files (.mscz) are zip archives containing the .mscx
+# file, which is found via META-INF/container.xml.
+MSCZ_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{0}"/>
+    </rootfiles>
+  </container>
+"""
+
+def is_mscz(filePath):
+    return filePath.lower().endswith('.mscz')
+
+def open_mscz(filePath):
+    # returns a file object that streams the score out of the archive
+    zf = zipfile.ZipFile(filePath)
+    try:
+        container = xmlbackend.fromstring(zf.read('META-INF/container.xml'))
+        name = container.find('rootfiles/rootfile').get('full-path')
+    except KeyError: # no container, so use the first .mscx file
+        name = next(n for n in zf.namelist() if n.lower().endswith('.mscx'))
+    f = zf.open(name)
+    zf.close() # the member stays readable until f is closed
+    return f
+
+def write_mscz(score, file, name, compresslevel=6):
+    # write score (anything with writeToFile) to file as a .mscz archive that
+    # contains it as `name`. Works with unseekable files like stdout.
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        zf.writestr('META-INF/container.xml', MSCZ_CONTAINER.format(name))
+        with zf.open(name, 'w') as f:
+            score.writeToFile(f)
+
+def write_file(score, filePath, compresslevel=6):
+    # write score (anything with writeToFile) to filePath, as a .mscz archive
+    # if it ends in .mscz (containing the .mscx of the same name). Goes via a
+    # temporary file so the output is never partial, as it may be an input.
+    tmp = filePath + ".part"
+    with open(tmp, 'wb') as f:
+        if is_mscz(filePath):
+            name = os.path.splitext(os.path.basename(filePath))[0] + ".mscx"
+            write_mscz(score, f, name, compresslevel)
+        else:
+            score.writeToFile(f)
+    os.replace(tmp, filePath)
+
+def normalize_score(scoreFile):
+    with timings.phase('normalize', scoreFile.filePath):
+        scoreFile.explicitCMajorKeySig()
+        scoreFile.explicitFinalBarline()
+
+def load_score(filePath, cache=None, normalize=True):
+    # Parse a score to append to another score, or the first score of a join
+    # if not normalize. ScoreJoin normalizes appended scores as it shifts
+    # them, so they are only normalized on their way into the cache (see
+    # cache.load).
+    if cache is None:
+        return ScoreFile(filePath)
+    return cache.load(filePath, normalize).scoreFile(filePath)
+
+def load_scores(filePaths, cache=None):
+    # Yield scores to append in order. They are loaded one at a time, as
+    # sending a parsed score from another process costs several times more
+    # than parsing it. (paralleljoin.ParallelScoreJoin sends serialized staff
+    # contents instead, which is cheap.)
+    for filePath in filePaths:
+        yield load_score(filePath, cache)
+
+# Jinja is only needed for covers with variable substitution, so it is
+# imported on first use. There is one environment per template directory and
+# each keeps up to TEMPLATE_CACHE_SIZE compiled templates, which it recompiles
+# if the file's mtime changes, so a cover used many times is compiled once.
+TEMPLATE_CACHE_SIZE = 50
+_jinja_environments = {}
+_jinja_bytecode_cache_dir = None
+
+def set_template_cache_dir(path):
+    # also cache compiled templates on disk (shared between processes)
+    global _jinja_bytecode_cache_dir
+    os.makedirs(path, exist_ok=True)
+    _jinja_bytecode_cache_dir = path
+    _jinja_environments.clear()
+
+def jinja_template(filePath):
+    import jinja2
+    dirname, basename = os.path.split(filePath)
+    env = _jinja_environments.get(dirname)
+    if env is None:
+        bytecode_cache = None
+        if _jinja_bytecode_cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(_jinja_bytecode_cache_dir)
+        env = jinja2.Environment(autoescape=jinja2.select_autoescape(['mscx']),
+                                 loader=jinja2.FileSystemLoader(searchpath=dirname),
+                                 cache_size=TEMPLATE_CACHE_SIZE,
+                                 bytecode_cache=bytecode_cache)
+        _jinja_environments[dirname] = env
+    return env.get_template(basename)
+
+def element_key(e):
+    # hashable value that is equal for elements that are equal in tag, text,
+    # tail, attributes and children
+    # (builtins.tuple as tuple() in this module means a time signature)
+    return (e.tag, e.text, e.tail, frozenset(e.attrib.items()), builtins.tuple(element_key(c) for c in e))
+
+def staff_def_key(sd):
+    # like element_key but IDs are allowed to differ
+    attrib = frozenset((k, v) for k, v in sd.attrib.items() if k != 'id')
+    return (sd.tag, sd.text, sd.tail, attrib, builtins.tuple(element_key(c) for c in sd))
+
+class StaffIndex:
+    # Parts, staves and staff definitions of a score looked up by staff ID
+    # (as a string). Built once per score as the part/staff structure doesn't
+    # change while joining, only the contents of the staves.
+    def __init__(self, score):
+        self.parts = score.findall('Part')
+        self.staves = score.findall('Staff')
+        self.staff = {}
+        self.staff_def = {}
+        self.part_for_staff = {}
+        self.staff_ids_for_part = []
+        self.staff_def_keys = {}
+        self.staff_def_hashes = {}
+        for staff in self.staves:
+            self.staff.setdefault(staff.get('id'), staff)
+        for part in self.parts:
+            ids = []
+            for staff_def in part.findall('Staff'):
+                id = staff_def.get('id')
+                ids.append(id)
+                if id in self.staff_def:
+                    continue # first one wins, like find()
+                key = staff_def_key(staff_def)
+                self.staff_def[id] = staff_def
+                self.part_for_staff[id] = part
+                self.staff_def_keys[id] = key
+                self.staff_def_hashes[id] = hash(key)
+            self.staff_ids_for_part.append(ids)
+
+    def same_staff_def(self, id, other, other_id):
+        # compare hashes first so most mismatches are found without a deep compare
+        return (self.staff_def_hashes[id] == other.staff_def_hashes[other_id]
+                and self.staff_def_keys[id] == other.staff_def_keys[other_id])
+
+class MeasureTimeline:
+    # Start tick and time signature of each measure in a staff. Start ticks
+    # are kept as prefix sums, so the total duration and the start and length
+    # of a measure take O(1) to look up, and the measure at a given tick takes
+    # O(log n). The timeline of an appended score is added on the end without
+    # rescanning the measures before it.
+    #
+    # The total duration (ticks), which the join shifts appended scores by,
+    # is counted as it always has been, with measure_length, which only sees
+    # MuseScore 2 time signatures, so the output doesn't change. The start
+    # ticks for lookups use the time signatures of MuseScore 3 scores too.
+    def __init__(self, ticksPerWhole):
+        self.ticksPerWhole = ticksPerWhole
+        self.starts = [0]        # start tick of each measure for lookups, then the end tick
+        self.joinStarts = [0]    # as the join counts them
+        self.timeSigs = []       # time signature in effect in each measure
+        self.joinTimeSig = fractions.Fraction(4,4) # as measure_length sees it, after the measures so far
+
+    def add_measure(self, measure):
+        joinLength, self.joinTimeSig = measure_length(measure, self.joinTimeSig)
+        timeSig = measure_time_sig(measure) or self.current_time_sig()
+        length = measure.get('len')
+        self.add(fractions.Fraction(length) if length else timeSig, timeSig, joinLength)
+
+    def add(self, length, timeSig, joinLength):
+        # add a measure of length whole notes (joinLength as the join counts
+        # it) in timeSig
+        self.starts.append(self.starts[-1] + length * self.ticksPerWhole)
+        self.joinStarts.append(self.joinStarts[-1] + joinLength * self.ticksPerWhole)
+        self.timeSigs.append(timeSig)
+
+    def current_time_sig(self):
+        return self.timeSigs[-1] if self.timeSigs else fractions.Fraction(4,4)
+
+    def extend(self, timeline):
+        # append another score's timeline (in its own ticks) to this one
+        offset = self.starts[-1]
+        self.starts.extend(offset + start for start in timeline.starts[1:])
+        offset = self.ticks
+        self.joinStarts.extend(offset + start for start in timeline.joinStarts[1:])
+        self.timeSigs.extend(timeline.timeSigs)
+
+    def truncate(self, length):
+        # keep only the first `length` measures
+        del self.starts[length + 1:]
+        del self.joinStarts[length + 1:]
+        del self.timeSigs[length:]
+
+    def __len__(self):
+        return len(self.timeSigs)
+
+    @property
+    def ticks(self):
+        return self.joinStarts[-1] # total duration, as the join counts it
+
+    def tick(self, idx):
+        return self.starts[idx]
+
+    def length(self, idx):
+        return self.starts[idx + 1] - self.starts[idx]
+
+    def time_sig(self, idx):
+        return self.timeSigs[idx]
+
+    def measure_at(self, tick):
+        # index of the measure that contains tick, or None if out of range
+        if tick < 0 or tick >= self.starts[-1]:
+            return None
+        return bisect.bisect_right(self.starts, tick) - 1
+
+# Solfège key names in instrument names and the letters they become. A key
+# at the end ("Flute Sol" or "Flute in Sol") becomes "Flute in G" and one
+# before a word ("Sol Flute") becomes "G Flute". Both are matched for all
+# keys at once, so a name is rewritten in two passes instead of two per key.
+SOLFEGE_KEYS = {"Do": "C", "Re": "D", "Mi": "E", "Fa": "F", "Sol": "G", "La": "A", "Si": "B"}
+SOLFEGE_KEY_AT_END = re.compile("(?: in)? (" + "|".join(SOLFEGE_KEYS) + ")$")
+SOLFEGE_KEY_BEFORE_WORD = re.compile("(^| )(" + "|".join(SOLFEGE_KEYS) + ")(?= )")
+LONG_INSTRUMENT_NAME = re.compile(r"^(([A-H]♭?) )?(.*?)( in (.*))?$")
+SHORT_INSTRUMENT_NAME = re.compile(r"^(([A-H]♭?) )?(.*?)([ \n]in (.*))?$")
+
+def letter_key_names(name):
+    name = SOLFEGE_KEY_AT_END.sub(lambda m: " in " + SOLFEGE_KEYS[m.group(1)], name)
+    return SOLFEGE_KEY_BEFORE_WORD.sub(lambda m: m.group(1) + SOLFEGE_KEYS[m.group(2)], name)
+
+# Element searches used on every staff of every score
+ELEMENTS_WITH_ID = xmlbackend.path('.//*[@id]')
+NUMBERED_MEASURES = xmlbackend.path('.//Measure[@number]')
+TICKS = xmlbackend.path('.//tick')
+
+# What to append to the staff at s_idx1 from the staff at s_idx2 of the next
+# score: 'append' its contents, or filler for a 'part missing' or 'staff
+# missing' for the duration of that staff.
+StaffMatch = collections.namedtuple('StaffMatch', ['action', 's_idx1', 's_idx2'])
+
+def match_staves(index1, index2, filePath, problems=None, log=eprint):
+    # Match parts and staves in score2 (filePath, with StaffIndex index2) to
+    # those in score1 (index1). Returns a list of StaffMatches, one for each
+    # staff of score1. Mismatches that stop the join raise AssertionError, or
+    # are added to problems as messages if it is a list.
+    def check(ok, message):
+        if problems is None:
+            assert(ok)
+        elif not ok:
+            problems.append(message)
+
+    check(len(index1.parts)  >= len(index2.parts), "%s has more parts than the first score" % filePath)
+    check(len(index1.staves) >= len(index2.staves), "%s has more staves than the first score" % filePath)
+    if not index2.parts:
+        check(False, "%s has no parts" % filePath)
+        return []
+
+    matches = []
+    p_idx2 = 0
+    s_idx2 = 0
+    part2 = index2.parts[p_idx2] # same part in next score
+
+    for p_idx1, part1 in enumerate(index1.parts):
+
+        long_name = part1.find("Instrument/longName").text
+        log(long_name)
+
+        if long_name != part2.find("Instrument/longName").text:
+            # part1 not in score2 so fill part1 staves with
+            # empty measures for the duration of part2.
+            log("Part1 not found in " + filePath)
+            for staff_id in index1.staff_ids_for_part[p_idx1]:
+                matches.append(StaffMatch('part missing', int(staff_id) - 1, s_idx2))
+            continue
+
+        instrument1 = part1.find("Instrument")
+        instrument2 = part2.find("Instrument")
+
+        short_name = instrument1.find("shortName").text
+        track_name = instrument1.find("trackName").text
+        instrument_id = instrument1.find("instrumentId").text
+
+        for tag, value in [("shortName", short_name), ("trackName", track_name), ("instrumentId", instrument_id)]:
+            other = instrument2.find(tag).text
+            check(value == other, "%s: %s of %s is %r, not %r" % (filePath, tag, long_name, other, value))
+
+        for staff_id in index1.staff_ids_for_part[p_idx1]:
+            s_idx1 = int(staff_id) - 1
+            staff_id2 = str(s_idx2 + 1) # IDs are one-indexed
+
+            if not part2 is index2.part_for_staff.get(staff_id2) or not index1.same_staff_def(staff_id, index2, staff_id2):
+                log("Staff1 not found in " + filePath)
+                matches.append(StaffMatch('staff missing', s_idx1, s_idx2))
+                continue
+
+            log("Part: %s, %s %s %s" % (p_idx1, long_name, short_name, track_name))
+            matches.append(StaffMatch('append', s_idx1, s_idx2))
+            s_idx2 += 1
+
+        # move to first staff in next part
+        p_idx2 += 1
+        try:
+            part2 = index2.parts[p_idx2]
+        except IndexError:
+            p_idx2 -= 1 # stay on previous part
+
+    # Filler takes its measures from the staff where the missing part or
+    # staff would have been, or from the first staff if that is past the
+    # last staff (all staves have the same measures).
+    for idx, match in enumerate(matches):
+        if match.action != 'append' and str(match.s_idx2 + 1) not in index2.staff:
+            matches[idx] = match._replace(s_idx2=0)
+    return matches
+
+# What to append to staff1 (at index s_idx1) from staff2 of the next score:
+# 'append' its contents, or filler for a 'part missing' or 'staff missing'.
+JoinStep = collections.namedtuple('JoinStep', ['action', 's_idx1', 'staff1', 'staff2'])
+
+# A measure of staff2 as StaffFiller sees it: its len attribute (or None),
+# the duration of a measure rest in it (e.g. "6/8"), the TimeSigs and
+# KeySigs before its first chord or rest and the BarLines after it (in its
+# first voice), and its other children (e.g. layout breaks and repeats) in
+# order, with None where the first voice goes.
+FillerMeasure = collections.namedtuple('FillerMeasure', ['len', 'duration', 'timeSigs', 'keySigs',
+                                                         'barLines', 'others'])
+
+class StaffFiller:
+    # Empty measures for the staves of the first score that an appended
+    # score doesn't have, for the duration of one of its staves (staff2):
+    # each measure gets a single measure rest, and keeps only what has to
+    # match the other staves (time signatures, barlines and measure-level
+    # elements like layout breaks) and the key signature if wanted. staff2
+    # is scanned once however many staves are filled from it, and the plain
+    # measures (the vast majority) are stamped out from one template per
+    # length, shared between staves where the XML backend allows (see
+    # xmlbackend.share). Runs of them show as multi-measure rests when the
+    # createMultiMeasureRests style is on.
+    def __init__(self, staff2):
+        self.items = [] # FillerMeasures, and frames as they are
+        self.templates = {} # plain measure for each (len, duration)
+        self.runs = {}      # filler for each (frames, keySigs)
+        currTimeSig = "4/4"
+        for child in staff2:
+            if child.tag != 'Measure':
+                self.items.append(child)
+                continue
+            timeSigs, keySigs, barLines, others = [], [], [], []
+            voice = None
+            for element in child:
+                if element.tag != 'voice':
+                    others.append(element)
+                elif voice is None:
+                    voice = element # keep first voice only
+                    others.append(None)
+            if voice is None:
+                others.append(None) # filler has a voice all the same
+            else:
+                foundCR = False
+                for element in voice:
+                    if element.tag in ['Chord', 'Rest']:
+                        foundCR = True
+                    elif element.tag == 'BarLine' and foundCR:
+                        barLines.append(element)
+                    elif foundCR:
+                        continue # e.g. a courtesy timesig at end of measure
+                    elif element.tag == 'TimeSig':
+                        currTimeSig = "%s/%s" % tuple(element)
+                        timeSigs.append(element)
+                    elif element.tag == 'KeySig':
+                        keySigs.append(element)
+            length = child.get('len')
+            duration = length if length else currTimeSig
+            self.items.append(FillerMeasure(length, duration, timeSigs, keySigs, barLines, others))
+
+    def fill(self, staff1, frames, keySigs):
+        # append filler for all of staff2 to staff1, with staff2's frames if
+        # frames is true and its key signatures if keySigs is true
+        run = self.runs.get((frames, keySigs))
+        if run is None:
+            run = self.runs[frames, keySigs] = self._run(frames, keySigs)
+        filler, lastMeasure = run
+        if xmlbackend.MULTIPLE_PARENTS and lastMeasure is not None:
+            # the last measure needs a copy of its own, as layout breaks
+            # may be added to it
+            staff1.extend(filler[:lastMeasure])
+            staff1.append(copy.deepcopy(filler[lastMeasure]))
+            staff1.extend(filler[lastMeasure + 1:])
+        else:
+            staff1.extend(xmlbackend.share(filler)[:]) # copied in one go if need be
+
+    def _run(self, frames, keySigs):
+        # the filler for one staff, in a container element, and the index of
+        # its last measure
+        filler = ET.Element('Staff')
+        length = 0 # len() of lxml elements isn't O(1)
+        lastMeasure = None
+        for item in self.items:
+            if not isinstance(item, FillerMeasure):
+                if frames:
+                    filler.append(xmlbackend.share(item))
+                    length += 1
+                continue
+            lastMeasure = length
+            length += 1
+            if item.timeSigs or (keySigs and item.keySigs) or item.barLines or item.others != [None]:
+                filler.append(self._measure(item, keySigs))
+            else:
+                filler.append(xmlbackend.share(self._template(item)))
+        return filler, lastMeasure
+
+    def _template(self, item):
+        key = (item.len, item.duration)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = self._measure(item, False)
+        return template
+
+    def _measure(self, item, keySigs):
+        measure = ET.Element('Measure')
+        if item.len:
+            measure.set('len', item.len)
+        measure.tail = "\n      " # no indents inside, to keep the output small
+        voice = ET.Element('voice')
+        for element in (item.keySigs if keySigs else []) + item.timeSigs:
+            voice.append(xmlbackend.share(element))
+        rest = ET.SubElement(voice, 'Rest')
+        ET.SubElement(rest, 'durationType').text = 'measure'
+        ET.SubElement(rest, 'duration').text = item.duration
+        for element in item.barLines:
+            voice.append(xmlbackend.share(element))
+        for element in item.others:
+            measure.append(voice if element is None else xmlbackend.share(element))
+        return measure
+
+def do_join_plan(plan, filePath):
+    # Append to each staff1 as the JoinSteps say. Filler is added before any
+    # staves are appended, as appending moves staff contents with some XML
+    # backends.
+    fillers = {} # missing staves usually take their filler from the same staff2
+    for step in plan:
+        if step.action == 'append':
+            continue
+        with timings.phase('filler', filePath):
+            filler = fillers.get(id(step.staff2))
+            if filler is None:
+                filler = fillers[id(step.staff2)] = StaffFiller(step.staff2)
+            # frames belong in the first staff only, and the key of a
+            # missing staff is that of its part, but not of another part
+            filler.fill(step.staff1, frames=step.s_idx1 == 0, keySigs=step.action == 'staff missing')
+    for step in plan:
+        if step.action == 'append':
+            with timings.phase('append', filePath):
+                step.staff1.extend(step.staff2[:])
+
+# IDs, measure numbers and duration (in ticks) of a score
+ScoreStats = collections.namedtuple('ScoreStats', ['maxElementID', 'maxMeasureNumber', 'ticks'])
 
 class ScoreFile:
-    def __init__(self, filePath, dictionary=None):
+    def __init__(self, filePath, dictionary=None, root=None, stats=None):
+        # root and stats are given for a score from the cache (see load_score)
         self.filePath = filePath
-        if dictionary:
-            self.root = ET.fromstring(self.substitute_variables(dictionary))
+        if root is not None:
+            self.root = root
+            self.tree = ET.ElementTree(self.root)
+        elif dictionary:
+            with timings.phase('render', filePath):
+                text = self.substitute_variables(dictionary)
+            with timings.phase('parse', filePath):
+                self.root = xmlbackend.fromstring(text)
             self.tree = ET.ElementTree(self.root)
         else:
-            self.tree = ET.parse(filePath)
+            with timings.phase('parse', filePath):
+                if is_mscz(filePath):
+                    with open_mscz(filePath) as f:
+                        self.tree = xmlbackend.parse(f)
+                else:
+                    self.tree = xmlbackend.parse(filePath)
             self.root = self.tree.getroot()
         self.score = self.root.find('Score')
         self.style = self.score.find('Style')
+        self._index = None
+        self._timeline = None
+        self._stats = stats # until the score is shifted, covered or joined onto
 
     def substitute_variables(self, dictionary):
-        dirname, basename = os.path.split(self.filePath)
-        env = jinja2.Environment(autoescape=jinja2.select_autoescape(['mscx']),loader=jinja2.FileSystemLoader(searchpath=dirname))
-        s = env.get_template(basename)
+        s = jinja_template(self.filePath)
         g = {
             'EOL': '\n',
             'DATE': datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M"),
         }
         return s.render(**g, **dictionary)
 
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = StaffIndex(self.score)
+        return self._index
+
     @property
     def parts(self):
-        return self.score.findall('Part')
+        return self.index.parts
 
     @property
     def staves(self):
-        return self.score.findall('Staff') # excludes Part/Staff (staff defs)
-
-    def part(self, idx):
-        return self.parts[idx]
+        return self.index.staves # excludes Part/Staff (staff defs)
 
     def staff(self, idx):
         id = idx + 1 # IDs are one-indexed
-        return self.score.find("Staff[@id='"+str(id)+"']")
-
-    def staff_def(self, idx):
-        id = idx + 1 # IDs are one-indexed
-        return self.score.find("Part/Staff[@id='"+str(id)+"']")
-
-    def part_for_staff(self, idx):
-        id = idx + 1 # IDs are one-indexed
-        return self.score.find("Part/Staff[@id='"+str(id)+"']/..")
+        return self.index.staff.get(str(id))
 
     def firstStaff(self):
         return self.score.find('Staff')
@@ -94,6 +632,11 @@ class ScoreFile:
             self.style.append(style)
         style.text = value
 
+    def show_multimeasure_rests(self):
+        # runs of empty measures (like filler, see StaffFiller) are shown as
+        # multi-measure rests
+        self.set_style('createMultiMeasureRests', '1')
+
     @property
     def spatium(self):
         return float(self.get_style('Spatium').text)
@@ -119,24 +662,7 @@ class ScoreFile:
     def explicitCMajorKeySig(self):
         # insert a C Major key signature if no key is specified
         for staff in self.staves:
-            firstMeasure = staff.find('Measure')
-            if firstMeasure is None:
-                continue
-            firstVoice = firstMeasure.find('voice')
-            if firstVoice is None:
-                continue
-            firstVoice.find('KeySig')
-            for element in firstVoice:
-                if element.tag == 'KeySig':
-                    break # staff already has an explicit keysig
-                if element.tag in ['Chord', 'Rest']:
-                    # no keysig before first Chord/Rest, so insert one now
-                    keysig = ET.Element('KeySig')
-                    keysig.tail = "\n          "
-                    accidental = ET.SubElement(keysig, 'accidental')
-                    accidental.text = "0" # C Major
-                    firstVoice.insert(0, keysig)
-                    break
+            explicitCMajorKeySig(staff)
 
     def explicitFinalBarline(self):
         # insert a final 'end' barline if no barline is specified
@@ -145,87 +671,102 @@ class ScoreFile:
                 finalMeasure = staff.findall('Measure')[-1]
             except IndexError:
                 continue # no measures in staff
-            firstVoice = finalMeasure.find('voice')
-            if firstVoice is None:
-                firstVoice = ET.SubElement(finalMeasure, 'voice')
-            try:
-                lastElement = firstVoice[-1]
-                if lastElement.tag == 'BarLine':
-                    continue # already has explicit final barline (any kind)
-            except IndexError:
-                pass # voice is empty
-            barline = ET.SubElement(firstVoice, 'BarLine')
-            barline.tail = "\n          "
-            ET.SubElement(barline, 'subtype').text = 'end'
+            explicitFinalBarline(finalMeasure)
 
     def maxElementID(self):
         max_ID = 0
         for staff in self.staves:
-            for elementWithID in staff.findall('.//*[@id]'):
+            for elementWithID in ELEMENTS_WITH_ID(staff):
                 id = int(elementWithID.get('id'))
                 max_ID = max(id, max_ID)
         return max_ID
 
-    def incrementElementIDs(self, offset):
-        for staff in self.staves:
-            for elementWithID in staff.findall('.//*[@id]'):
-                ID = int(elementWithID.get('id'))
-                elementWithID.set('id', str(ID + offset))
-            # update beam and tuplet numbers to match new IDs
-            for tag in ["Beam", "Tuplet"]:
-                for element in staff.findall('.//' + tag):
-                    try:
-                        element.text = str(int(element.text) + offset)
-                    except ValueError:
-                        pass # had an ID, not a number
-
     def maxMeasureNumber(self):
         max_measure_num = 0
         for staff in self.staves:
-            for measure in staff.findall('.//Measure[@number]'):
+            for measure in NUMBERED_MEASURES(staff):
                 measure_num = int(measure.get('number'))
                 max_measure_num = max(measure_num, max_measure_num)
         return max_measure_num
 
-    def incrementMeasureNumbers(self, offset):
-        for staff in self.staves:
-            for measure in staff.findall('.//Measure[@number]'):
-                measure_num = int(measure.get('number'))
-                measure.set('number', str(measure_num + offset))
+    @property
+    def division(self):
+        return int(self.root.find('Score/Division').text) # ticks per quarter note
 
-    def incrementTicks(self, offset):
-        for staff in self.staves:
-            for tick in staff.findall('.//tick'):
-                tick_num = int(tick.text)
-                tick.text = str(tick_num + offset)
+    @property
+    def timeline(self):
+        # built on first use; kept up to date by ScoreJoin when appending
+        if self._timeline is None:
+            timeline = MeasureTimeline(self.division * 4)
+            for measure in self.firstStaff().findall('Measure'):
+                timeline.add_measure(measure)
+            self._timeline = timeline
+        return self._timeline
 
     def ticks(self):
-        division = int(self.root.find('Score/Division').text) # ticks per quarter note
-        duration = fractions.Fraction(0,4)
-        currTimeSig = fractions.Fraction(4,4)
-        for measure in self.firstStaff().findall('Measure'):
-            for element in measure:
-                if element.tag == 'TimeSig':
-                    currTimeSig = fraction(element)
-                    break # TimeSig found, so stop looking
-                elif element.tag in ['Note', 'Rest']:
-                    break # ignore possible courtesy TimeSig at end of measure.
-            children = list(measure)
-            length = measure.get('len')
-            if length: # anacrusis/irregular measure
-                l = fractions.Fraction(length)
-                duration += l
-            else: # normal measure
-                duration += currTimeSig
-        return duration * division * 4
+        return self.timeline.ticks
+
+    def stats(self):
+        if self._stats is None:
+            self._stats = ScoreStats(self.maxElementID(), self.maxMeasureNumber(), self.ticks())
+        return self._stats
+
+    def normalize_and_shift(self, idOffset, measureOffset, tickOffset):
+        # Makes the key signature and final barline of each staff explicit
+        # and adds the offsets to its element IDs (and beam and tuplet
+        # numbers), measure numbers and ticks, in a single walk over each
+        # staff. Returns the stats of the shifted score.
+        max_ID = 0
+        max_measure_num = 0
+        timeline = MeasureTimeline(self.division * 4)
+        firstStaff = self.firstStaff()
+        for staff in self.staves:
+            explicitCMajorKeySig(staff)
+            finalMeasure = None
+            for child in staff:
+                if child.tag == 'Measure':
+                    finalMeasure = child
+                    if staff is firstStaff:
+                        timeline.add_measure(child)
+                for element in child.iter():
+                    ID = element.get('id')
+                    if ID is not None:
+                        ID = int(ID) + idOffset
+                        element.set('id', str(ID))
+                        max_ID = max(ID, max_ID)
+                    tag = element.tag
+                    if tag == 'Measure':
+                        measure_num = element.get('number')
+                        if measure_num is not None:
+                            measure_num = int(measure_num) + measureOffset
+                            element.set('number', str(measure_num))
+                            max_measure_num = max(measure_num, max_measure_num)
+                    elif tag == 'tick':
+                        element.text = str(int(element.text) + tickOffset)
+                    elif tag in ['Beam', 'Tuplet']:
+                        # update beam and tuplet numbers to match new IDs
+                        try:
+                            element.text = str(int(element.text) + idOffset)
+                        except ValueError:
+                            pass # had an ID, not a number
+            if finalMeasure is not None:
+                explicitFinalBarline(finalMeasure)
+        self._timeline = timeline
+        self._stats = None
+        return ScoreStats(max_ID, max_measure_num, timeline.ticks)
+
+    def finalMeasure(self):
+        # search backwards so cost doesn't grow with the length of the score
+        for element in reversed(self.firstStaff()):
+            if element.tag == 'Measure':
+                return element
+        return None
 
     def appendLayoutBreak(self, type): # line, page, section
-        if self.firstStaff().find('Measure') is not None:
-            layoutBreak = ET.Element('LayoutBreak')
-            subtype = ET.SubElement(layoutBreak, 'subtype')
-            subtype.text = type
-            finalMeasure = self.firstStaff().findall('Measure')[-1]
-            finalMeasure.append(layoutBreak)
+        finalMeasure = self.finalMeasure()
+        if finalMeasure is not None:
+            return appendLayoutBreak(finalMeasure, type)
+        return None
 
     def scale_frame_height(self, spatium):
         for h in self.score.findall('.//height'):
@@ -239,197 +780,298 @@ class ScoreFile:
             if style.find('TextStyle[name=\'' + style_name + '\']') == None:
                 style.append(text_style)
 
+    def save_header(self):
+        # Copy everything except the staves, and note the length of the
+        # first staff, so that restore_header can undo prepend_cover and
+        # other changes to styles and meta tags.
+        children = [child if child.tag == 'Staff' else copy.deepcopy(child) for child in self.score]
+        return children, len(self.firstStaff())
+
+    def restore_header(self, saved):
+        children, firstStaffLength = saved
+        firstStaff = self.firstStaff()
+        del firstStaff[:len(firstStaff) - firstStaffLength] # prepended frames
+        self.score[:] = children
+        self.style = self.score.find('Style')
+        self._index = None
+        self._stats = None
+
     def prepend_cover(self, cover):
+        self._stats = None
         cover.scale_frame_height(self.spatium)
         firstStaff = self.firstStaff()
-        for frame in reversed(cover.firstStaff()):
+        for frame in reversed(cover.firstStaff()[:]):
             if frame.tag == "Measure":
                 break
             firstStaff.insert(0, frame)
         self.add_text_styles_from_score_file(cover)
 
-    def fix_instrument_names(self):
+    def fix_instrument_names(self, log=eprint):
         parts = {}
         for part in self.score.findall(".//Instrument/.."):
             instrument = part.find("Instrument")
             long_name = instrument.find("longName").text
             if long_name in parts:
-                parts[long_name].append(part)
+                parts[long_name].append((part, instrument))
             else:
-                parts[long_name] = [part]
+                parts[long_name] = [(part, instrument)]
         for long_name, occurrences in parts.items():
-            keys = {
-                "C": "Do",
-                "D": "Re",
-                "E": "Mi",
-                "F": "Fa",
-                "G": "Sol",
-                "A": "La",
-                "B": "Si",
-            }
-            short_name = occurrences[0].find("Instrument").find("shortName").text
-            eprint(long_name + "\t\t\t" + short_name)
-            for let, name in keys.items():
-                long_name = re.sub("( in)? "+name+"$", r" in "+let, long_name)
-                long_name = re.sub("(^| )"+name+" ", r"\1"+let+r" ", long_name)
-                short_name = re.sub("( in)? "+name+"$", r" in "+let, short_name)
-                short_name = re.sub("(^| )"+name+" ", r"\1"+let+r" ", short_name)
-            eprint(long_name + "\t\t\t" + short_name)
+            short_name = occurrences[0][1].find("shortName").text
+            log(long_name + "\t\t\t" + short_name)
+            long_name = letter_key_names(long_name)
+            short_name = letter_key_names(short_name)
+            log(long_name + "\t\t\t" + short_name)
             total = len(occurrences)
-            match = re.search(r"^(([A-H]♭?) )?(.*?)( in (.*))?$", long_name)
+            match = LONG_INSTRUMENT_NAME.search(long_name)
             assert(match)
             key = match.group(2)
             if not key:
                 key = match.group(5)
             long = match.group(3)
-            match = re.search(r"^(([A-H]♭?) )?(.*?)([ \n]in (.*))?$", short_name)
+            match = SHORT_INSTRUMENT_NAME.search(short_name)
             assert(match)
             short = match.group(3)
-            for num, part in enumerate(occurrences, 1):
-                instrument = part.find("Instrument")
-                for tag in ["longName", "shortName", "trackName"]:
-                    text = short if tag == "shortName" else long
-                    if total > 1:
-                        text += " " + str(num)
-                    if key:
-                        text += ("\n" if tag == "shortName" else " ") + "in " + key
-                    instrument.find(tag).text = text
-                part.find("trackName").text = instrument.find("trackName").text
+            for num, (part, instrument) in enumerate(occurrences, 1):
+                number = " " + str(num) if total > 1 else ""
+                inKey = " in " + key if key else ""
+                long_text = long + number + inKey
+                instrument.find("longName").text = long_text
+                instrument.find("shortName").text = short + number + inKey.replace(" ", "\n", 1)
+                instrument.find("trackName").text = long_text
+                part.find("trackName").text = long_text
         self.set_style("shortInstrumentAlign", "center,center")
 
     def append_score(self, scoreFile, addLineBreak, addPageBreak, addSectionBreak):
-        # score1 must include all parts and staves that are in score2.
+        # One-off append. Use ScoreJoin directly to append several scores
+        # without rescanning this score each time.
+        ScoreJoin(self).append_score(scoreFile, addLineBreak, addPageBreak, addSectionBreak)
+
+    def join_plan(self, scoreFile):
+        # Returns a list of JoinSteps saying what to append to each staff in
+        # turn. score1 must include all parts and staves that are in score2.
         # score2 needn't include all parts and staves from score1.
-        assert(len(self.parts)  >= len(scoreFile.parts))
-        assert(len(self.staves) >= len(scoreFile.staves))
+        plan = []
+        for match in match_staves(self.index, scoreFile.index, scoreFile.filePath):
+            plan.append(JoinStep(match.action, match.s_idx1, self.staff(match.s_idx1), scoreFile.staff(match.s_idx2)))
+        return plan
 
-        self.explicitFinalBarline()
+    def append_staves(self, scoreFile):
+        # Returns the plan.
+        plan = self.join_plan(scoreFile)
+        do_join_plan(plan, scoreFile.filePath)
+        return plan
 
-        if addPageBreak:
-            self.appendLayoutBreak('page')
-        elif addLineBreak:
-            self.appendLayoutBreak('line')
+    def writeToFile(self, file):
+        xmlbackend.write(self.tree, file)
 
-        if addSectionBreak:
-            self.appendLayoutBreak('section')
-        else:
-            scoreFile.incrementMeasureNumbers(self.maxMeasureNumber())
 
-        scoreFile.explicitCMajorKeySig()
+class ScoreJoin:
+    # Appends scores onto a first score. Keeps running totals of the element
+    # IDs and measure numbers used so far, and the measure timeline of the
+    # first score, and updates them from each appended score only, so joining
+    # N scores takes time linear in the size of the output rather than
+    # rescanning the growing first score N times.
+    def __init__(self, scoreFile):
+        self.scoreFile = scoreFile
         scoreFile.explicitFinalBarline()
-        scoreFile.incrementElementIDs(self.maxElementID())
-        scoreFile.incrementTicks(self.ticks())
-
-        p_idx2 = 0
-        s_idx2 = 0
-        part2 = scoreFile.part(p_idx2)   # same part in next score
-        staff2 = scoreFile.staff(s_idx2) # same staff in next score
-
-        for p_idx1, part1 in enumerate(self.parts):
-
-            long_name = part1.find("Instrument/longName").text
-            eprint(long_name)
-
-            if long_name != part2.find("Instrument/longName").text:
-                # part1 not in score2 so fill part1 staves with
-                # empty measures for the duration of part2.
-                eprint("Part1 not found in " + scoreFile.filePath)
-                for staff_def in part1.findall('Staff'):
-                    s_idx1 = int(staff_def.get('id')) - 1
-                    staff1 = self.staff(s_idx1)
-                    currTimeSig = fractions.Fraction(4,4)
-                    for measure in staff2:
-                        if measure.tag != 'Measure':
-                            staff1.append(measure) # append frames
-                            continue
-                        for element in measure:
-                            if element.tag == 'TimeSig':
-                                currTimeSig = fraction(element)
-                                break # TimeSig found, so stop looking
-                            elif element.tag in ['Note', 'Rest']:
-                                break # ignore possible courtesy TimeSig at end of measure.
-                        rest = ET.Element('Rest')
-                        ET.SubElement(rest, 'durationType').text = 'measure'
-                        ET.SubElement(rest, 'duration').text = str(currTimeSig)
-                        staff1.append(rest)
-                continue
+        stats = scoreFile.stats() # from the cache if it was loaded from there
+        self.maxElementID = stats.maxElementID
+        self.maxMeasureNumber = stats.maxMeasureNumber
+        self.timeline = scoreFile.timeline
+        scoreFile._stats = None # the join keeps the totals from here on
 
-            instrument1 = part1.find("Instrument")
-            instrument2 = part2.find("Instrument")
-
-            short_name = instrument1.find("shortName").text
-            track_name = instrument1.find("trackName").text
-            instrument_id = instrument1.find("instrumentId").text
-
-            assert(short_name == instrument2.find("shortName").text)
-            assert(track_name == instrument2.find("trackName").text)
-            assert(instrument_id == instrument2.find("instrumentId").text)
-
-            for staff_def in part1.findall('Staff'):
-                s_idx1 = int(staff_def.get('id')) - 1
-                staff1 = self.staff(s_idx1)
-
-                if not part2 is scoreFile.part_for_staff(s_idx2) or not stave_defs_equal(staff_def, scoreFile.staff_def(s_idx2)):
-                    eprint("Staff1 not found in " + scoreFile.filePath)
-                    # staff1 not in score2 so fill staff1 with
-                    # empty measures for the duration of staff2.
-                    currTimeSig = (4,4)
-                    for measure in staff2:
-                        if measure.tag != 'Measure':
-                            # append frames to first staff only
-                            if s_idx1 == 0:
-                                staff1.append(measure)
-                            continue
-                        new_measure = ET.SubElement(staff1, 'Measure')
-                        new_measure.text = "\n        "
-                        new_measure.tail = "\n      "
-                        foundVoice = False
-                        for voice in measure:
-                            if voice.tag != 'voice':
-                                # keep layout breaks
-                                new_measure.append(voice)
-                                continue
-                            # keep first voice only
-                            if foundVoice:
-                                continue
-                            foundVoice = True
-                            new_voice = ET.SubElement(new_measure, 'voice')
-                            new_voice.text = "\n          "
-                            new_voice.tail = "\n        "
-                            foundCR = False
-                            for element in voice:
-                                if element.tag in ['Chord', 'Rest']:
-                                    if foundCR:
-                                        continue # don't add element.
-                                    foundCR = True
-                                    # Create single rest to fill measure.
-                                    rest = ET.SubElement(new_voice, 'Rest')
-                                    rest.tail = "\n          "
-                                    ET.SubElement(rest, 'durationType').text = 'measure'
-                                    # ET.SubElement(rest, 'duration').text = "%s/%s" % currTimeSig
-                                    continue # don't add original element
-                                if element.tag == 'TimeSig':
-                                    # Is it a courtesy timesig at end of measure?
-                                    if not foundCR: # No, it is real timesig.
-                                        currTimeSig = tuple(element)
-                                new_voice.append(element)
-                    continue
-
-                eprint("Part: %s, %s %s %s" % (p_idx1, long_name, short_name, track_name))
-                for child in staff2:
-                    staff1.append(child)
-                s_idx2 += 1
-                try:
-                    staff2 = scoreFile.staff(s_idx2)
-                except IndexError:
-                    s_idx2 -= 1 # stay on previous staff
-
-            # move to first staff in next part
-            p_idx2 += 1
-            try:
-                part2 = scoreFile.part(p_idx2)
-            except IndexError:
-                p_idx2 -= 1 # stay on previous part
+    @property
+    def ticks(self):
+        return self.timeline.ticks
+
+    def append_score(self, scoreFile, addLineBreak, addPageBreak, addSectionBreak):
+        self.add_layout_breaks(addLineBreak, addPageBreak, addSectionBreak)
+
+        measureOffset = 0 if addSectionBreak else self.maxMeasureNumber
+        with timings.phase('offsets', scoreFile.filePath):
+            stats = scoreFile.normalize_and_shift(self.maxElementID, measureOffset, self.ticks)
+        self.add_stats(stats, scoreFile.timeline)
+
+        self.scoreFile.append_staves(scoreFile)
+
+    def add_layout_breaks(self, addLineBreak, addPageBreak, addSectionBreak):
+        # returns the LayoutBreak elements that were added
+        layoutBreaks = []
+        for type in layout_break_types(addLineBreak, addPageBreak, addSectionBreak):
+            layoutBreaks.append(self.scoreFile.appendLayoutBreak(type))
+        return [b for b in layoutBreaks if b is not None]
+
+    def add_stats(self, stats, timeline):
+        # stats and timeline of a score appended after being shifted by the
+        # current offsets
+        self.maxElementID = max(self.maxElementID, stats.maxElementID)
+        self.maxMeasureNumber = max(self.maxMeasureNumber, stats.maxMeasureNumber)
+        self.timeline.extend(timeline)
+
+    def writeToFile(self, file):
+        with timings.phase('serialize', self.scoreFile.filePath):
+            self.scoreFile.writeToFile(file)
+
+
+class StreamingScoreJoin(ScoreJoin):
+    # Like ScoreJoin, but the contents of each staff are written out to a
+    # temporary file after every append and removed from the tree, so memory
+    # is bounded by the largest input score rather than by the whole output.
+    def __init__(self, scoreFile):
+        super().__init__(scoreFile)
+        self.spools = [tempfile.TemporaryFile() for staff in scoreFile.staves]
+        self.flush()
+
+    def append_score(self, scoreFile, addLineBreak, addPageBreak, addSectionBreak):
+        super().append_score(scoreFile, addLineBreak, addPageBreak, addSectionBreak)
+        with timings.phase('serialize', scoreFile.filePath):
+            self.flush()
+
+    def flush(self, keepFinalMeasure=True):
+        for staff, spool in zip(self.scoreFile.staves, self.spools):
+            self.flush_staff(staff, spool, keepFinalMeasure)
+
+    def flush_staff(self, staff, spool, keepFinalMeasure):
+        end = len(staff)
+        if keepFinalMeasure:
+            # keep final measure so a layout break can be added to it later
+            for idx in reversed(range(end)):
+                if staff[idx].tag == 'Measure':
+                    end = idx
+                    break
+        for child in staff[:end]:
+            spool.write(xmlbackend.tostring(child))
+        del staff[:end]
+
+    def writeToFile(self, file):
+        with timings.phase('serialize', self.scoreFile.filePath):
+            self._writeToFile(file)
+
+    def _writeToFile(self, file):
+        self.flush(keepFinalMeasure=False)
+        # Write the score with a placeholder in each staff, then replace the
+        # placeholders with the spooled staff contents.
+        staves = self.scoreFile.staves
+        texts = []
+        for idx, staff in enumerate(staves):
+            texts.append(staff.text or "")
+            staff.text = "@@staff-" + str(idx) + "@@"
+        skeleton = io.BytesIO()
+        self.scoreFile.writeToFile(skeleton)
+        remainder = skeleton.getvalue()
+        for idx, staff in enumerate(staves):
+            before, remainder = remainder.split(staff.text.encode("UTF-8"), 1)
+            file.write(before)
+            file.write(texts[idx].encode("UTF-8"))
+            spool = self.spools[idx]
+            spool.seek(0)
+            shutil.copyfileobj(spool, file)
+            spool.close()
+            staff.text = texts[idx]
+        file.write(remainder)
+
+
+# A score appended by IncrementalScoreJoin: the offsets it was shifted by,
+# its stats after shifting, the state of the join before it was appended,
+# and the join plan that appended it.
+Appended = collections.namedtuple('Appended', ['scoreFile', 'breaks', 'offsets', 'stats', 'state',
+                                               'staffLengths', 'finalMeasure', 'layoutBreaks', 'plan'])
+
+class IncrementalScoreJoin(ScoreJoin):
+    # ScoreJoin that can undo the appends after a given score. Appending only
+    # adds elements to the end of each staff (the appended scores keep their
+    # own staves, or get their contents back with backends where appending
+    # moves elements), so undoing is a matter of truncating the staves,
+    # removing the layout breaks and restoring the running totals. Undone scores can be
+    # appended again: they are only shifted again if their offsets change.
+    def __init__(self, scoreFile):
+        super().__init__(scoreFile)
+        self.appended = []
+
+    def append_score(self, scoreFile, addLineBreak, addPageBreak, addSectionBreak, previous=None):
+        # previous is the Appended record if scoreFile was appended (and
+        # shifted) before and then undone.
+        state = (self.maxElementID, self.maxMeasureNumber, len(self.timeline))
+        staffLengths = [len(staff) for staff in self.scoreFile.staves]
+        finalMeasure = self.scoreFile.finalMeasure()
+        layoutBreaks = self.add_layout_breaks(addLineBreak, addPageBreak, addSectionBreak)
+
+        measureOffset = 0 if addSectionBreak else self.maxMeasureNumber
+        offsets = (self.maxElementID, measureOffset, self.ticks)
+        if previous is not None and previous.offsets == offsets:
+            stats = previous.stats # already shifted by the right amount
+        else:
+            old = previous.offsets if previous is not None else (0, 0, 0)
+            with timings.phase('offsets', scoreFile.filePath):
+                stats = scoreFile.normalize_and_shift(*(n - o for n, o in zip(offsets, old)))
+        self.add_stats(stats, scoreFile.timeline)
+
+        plan = self.scoreFile.append_staves(scoreFile)
+        self.appended.append(Appended(scoreFile, (addLineBreak, addPageBreak, addSectionBreak), offsets, stats,
+                                      state, staffLengths, finalMeasure, layoutBreaks, plan))
+
+    def undo(self, idx):
+        # Undo appends from the idx-th appended score onwards and return
+        # their Appended records (in order) so they can be appended again.
+        undone = self.appended[idx:]
+        del self.appended[idx:]
+        staves = self.scoreFile.staves
+        for a in reversed(undone):
+            for layoutBreak in a.layoutBreaks:
+                a.finalMeasure.remove(layoutBreak)
+            if not xmlbackend.MULTIPLE_PARENTS:
+                # appending moved the staff contents, so move them back
+                for step in a.plan:
+                    if step.action == 'append':
+                        length = a.staffLengths[staves.index(step.staff1)]
+                        step.staff2.extend(step.staff1[length:])
+            # truncate now so that the filler added for this score isn't
+            # moved back with the contents of the score before it
+            for staff, length in zip(staves, a.staffLengths):
+                del staff[length:]
+        if undone:
+            self.maxElementID, self.maxMeasureNumber, measures = undone[0].state
+            self.timeline.truncate(measures)
+        return undone
+
+
+class VariantScoreJoin(ScoreJoin):
+    # ScoreJoin for writing several variants of one join that differ only in
+    # their layout breaks (and covers, see ScoreFile.save_header). Scores are
+    # appended without layout breaks, and each variant's breaks are added
+    # only while it is written. Section breaks reset the measure numbers of
+    # appended scores, so whether there are section breaks is fixed for the
+    # join unless the scores have no measure numbers.
+    def __init__(self, scoreFile, addSectionBreak):
+        super().__init__(scoreFile)
+        self.addSectionBreak = addSectionBreak
+        self.boundaries = [] # final measure of first staff before each append
+        self.breaks = (False, False, addSectionBreak)
+
+    def append_score(self, scoreFile):
+        self.boundaries.append(self.scoreFile.finalMeasure())
+        measureOffset = 0 if self.addSectionBreak else self.maxMeasureNumber
+        with timings.phase('offsets', scoreFile.filePath):
+            stats = scoreFile.normalize_and_shift(self.maxElementID, measureOffset, self.ticks)
+        self.add_stats(stats, scoreFile.timeline)
+        self.scoreFile.append_staves(scoreFile)
+
+    def can_write(self, addSectionBreak):
+        return addSectionBreak == self.addSectionBreak or self.maxMeasureNumber == 0
+
+    def select(self, addLineBreak, addPageBreak, addSectionBreak):
+        # set the layout breaks for writeToFile
+        assert(self.can_write(addSectionBreak))
+        self.breaks = (addLineBreak, addPageBreak, addSectionBreak)
 
     def writeToFile(self, file):
-        self.tree.write(file, encoding="UTF-8", xml_declaration="True")
+        layoutBreaks = []
+        for measure in self.boundaries:
+            if measure is not None:
+                for type in layout_break_types(*self.breaks):
+                    layoutBreaks.append((measure, appendLayoutBreak(measure, type)))
+        try:
+            super().writeToFile(file)
+        finally:
+            for measure, layoutBreak in layoutBreaks:
+                measure.remove(layoutBreak)
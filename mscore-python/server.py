@@ -0,0 +1,61 @@
+import argparse
+import cache
+import cli
+import contextlib
+import io
+import json
+import os
+import signal
+import socketserver
+import sys
+import timings
+import traceback
+
+# Long-running join server listening on a Unix socket. Parsed movements are
+# kept in a bounded in-memory cache and compiled cover templates stay loaded,
+# so repeated requests don't pay for startup, imports or parsing again.
+#
+# Protocol: the client sends the mscore-join.py arguments (plus 'cwd') as one
+# line of JSON. The server replies with one line of JSON, {"status": exit
+# status, "stderr": log messages, "length": N}, followed by N bytes of output.
+# Requests are handled one at a time.
+
+class JoinHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        output = io.BytesIO()
+        errors = io.StringIO()
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.pop('cwd'))
+            with contextlib.redirect_stderr(errors):
+                status = cli.run(argparse.Namespace(**request), output, self.server.scoreCache)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc(file=errors)
+            status = 1
+        finally:
+            os.chdir(cwd)
+            timings.disable() # stop recording (and tracing memory) for later requests
+        data = output.getvalue()
+        header = {'status': status, 'stderr': errors.getvalue(), 'length': len(data)}
+        try:
+            self.wfile.write(json.dumps(header).encode() + b'\n')
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # client went away
+
+def serve(socketPath, args):
+    scoreCache = cache.MemoryScoreCache(args.cache_size*1024*1024, cli.open_cache(args))
+    if os.path.exists(socketPath):
+        os.remove(socketPath) # left over from a server that didn't shut down
+    with socketserver.UnixStreamServer(socketPath, JoinHandler) as server:
+        server.scoreCache = scoreCache
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socketPath)
@@ -0,0 +1,120 @@
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None # not on Windows
+
+# Wall time of each phase of a join, per input file, and optionally the peak
+# memory that each phase allocates. Off unless enable() is called, in which
+# case phase() records into _timings. Tracing memory makes everything
+# several times slower, so it is only done if asked for, and the times are
+# only representative without it.
+_timings = None
+
+class Timings:
+    def __init__(self, traceMemory=False):
+        self.start = time.perf_counter()
+        self.traceMemory = traceMemory
+        self.phases = {} # (file, phase) -> [seconds, peak bytes or None, count]
+
+    def add(self, file, phase, seconds, peak, count=1):
+        record = self.phases.get((file, phase))
+        if record is None:
+            self.phases[(file, phase)] = [seconds, peak, count]
+        else:
+            record[0] += seconds
+            if peak is not None:
+                record[1] = peak if record[1] is None else max(record[1], peak)
+            record[2] += count
+
+    def records(self):
+        return [(file, phase, *record) for (file, phase), record in self.phases.items()]
+
+    def to_json(self):
+        return {
+            'total_seconds': time.perf_counter() - self.start,
+            'peak_bytes': tracemalloc.get_traced_memory()[1] if self.traceMemory else None,
+            'max_rss_bytes': max_rss(),
+            'phases': [
+                {'file': file, 'phase': phase, 'seconds': seconds, 'peak_bytes': peak, 'count': count}
+                for file, phase, seconds, peak, count in self.records()
+            ],
+        }
+
+def max_rss():
+    # peak resident memory of this process so far, in bytes (or None)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024 # kilobytes on Linux
+
+def enable(traceMemory=False):
+    global _timings
+    if traceMemory:
+        tracemalloc.start()
+    _timings = Timings(traceMemory)
+
+def disable():
+    # stop recording (e.g. after a request to the join server)
+    global _timings
+    _timings = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def enabled():
+    return _timings is not None
+
+@contextlib.contextmanager
+def phase(name, file):
+    if _timings is None:
+        yield
+        return
+    if not _timings.traceMemory:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _timings.add(file, name, time.perf_counter() - start, None)
+        return
+    # the peak is of what was allocated during the phase, not of all memory
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _timings.add(file, name, seconds, tracemalloc.get_traced_memory()[1] - before)
+
+def worker_settings():
+    # what start_worker needs to record in a worker as this process does
+    return None if _timings is None else _timings.traceMemory
+
+def start_worker(settings):
+    # Pool initializer: record in the worker process if the parent process
+    # does (pass worker_settings()). Forked workers inherit the parent's
+    # records and others start without any, so start afresh either way.
+    global _timings
+    _timings = None if settings is None else Timings(settings)
+    if settings and not tracemalloc.is_tracing():
+        tracemalloc.start() # only forked workers inherit tracing
+
+def take():
+    # remove and return records so far (e.g. to send from a worker process)
+    records = _timings.records()
+    _timings.phases.clear()
+    return records
+
+def extend(records):
+    for record in records:
+        _timings.add(*record)
+
+def write(path):
+    with open(path, 'w') as f:
+        json.dump(_timings.to_json(), f, indent=2)
+        f.write('\n')
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import yaml
+import recipe
+import score
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+def signature(path):
+    # changes whenever the file is modified (or replaced)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+class RecipeWatcher:
+    # Rebuilds a recipe's output when any file it uses changes. If only
+    # movements changed, the join is undone back to the first changed
+    # movement and only that and later movements are appended again.
+    # Unchanged movements are not parsed again and are only re-shifted if
+    # an earlier movement's duration or ID range changed.
+    def __init__(self, recipeFile, cache=None):
+        self.recipeFile = recipeFile
+        self.cache = cache
+        self.join = None
+        self.base = None       # signatures of recipe, first score and covers
+        self.movements = []    # (path, signature) for each appended score
+        self.seen = []         # (path, signature) for each file of the build
+        self.failed = None     # self.seen for the last build, if it failed
+
+    def build(self):
+        # Returns number of movements (re)appended, or None if nothing changed.
+        if self.failed is not None and all(signature(p) == s for p, s in self.failed):
+            return None # wait for a change before trying again
+        self.seen = [(self.recipeFile, signature(self.recipeFile))]
+        try:
+            appended = self._build()
+        except Exception:
+            self.failed = self.seen
+            self.join = None # start again from scratch next time
+            raise
+        self.failed = None
+        return appended
+
+    def _build(self):
+        r = recipe.Recipe(yaml.safe_load(open(self.recipeFile)))
+        scores = r.scores()
+        if not scores:
+            raise ValueError("No scores!")
+        base = [(path, signature(path)) for path in [self.recipeFile, scores[0]] + r.covers()]
+        movements = [(path, signature(path)) for path in scores[1:]]
+        self.seen = base + movements
+
+        if self.join is None or base != self.base:
+            # start again from the first score
+            firstScore = score.ScoreFile(scores[0])
+            for cover in reversed(r.covers()):
+                firstScore.prepend_cover(score.ScoreFile(cover, r))
+            self.join = score.IncrementalScoreJoin(firstScore)
+            self.base = base
+            self.movements = []
+
+        changed = 0
+        while changed < min(len(movements), len(self.movements)) and movements[changed] == self.movements[changed]:
+            changed += 1
+        if changed == len(movements) == len(self.movements):
+            return None
+
+        undone = self.join.undo(changed)
+        for idx in range(changed, len(movements)):
+            previous = None
+            if idx - changed < len(undone) and movements[idx] == self.movements[idx]:
+                previous = undone[idx - changed]
+            if previous is not None:
+                self.join.append_score(previous.scoreFile, *previous.breaks, previous=previous)
+            else:
+                scoreFile = score.load_score(movements[idx][0], self.cache)
+                self.join.append_score(scoreFile, False, True, True)
+        self.movements = movements
+        return len(movements) - changed
+
+def watch_recipe(recipeFile, write, cache=None, interval=0.5):
+    # Build recipeFile with write(join) whenever its files change. Runs until
+    # interrupted.
+    watcher = RecipeWatcher(recipeFile, cache)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                appended = watcher.build()
+            except Exception as e:
+                eprint("Build failed: %s: %s" % (type(e).__name__, e))
+                appended = None
+            if appended is not None:
+                write(watcher.join)
+                eprint("Built %s in %.3f s (appended %d of %d movements)"
+                       % (recipeFile, time.perf_counter() - start, appended, len(watcher.movements)))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,101 @@
+# The XML engine used for scores. lxml is used if it is installed, as it
+# parses and serializes much faster and compiles XPath expressions, and the
+# standard library's ElementTree otherwise. Set MSCORE_XML=etree to use
+# ElementTree even when lxml is installed. Output is the same either way.
+
+import contextlib
+import copy
+import gc
+import os
+
+NAME = 'etree'
+if os.environ.get('MSCORE_XML', 'lxml') == 'lxml':
+    try:
+        from lxml import etree as ET
+        NAME = 'lxml'
+    except ImportError:
+        pass # fall back to ElementTree
+if NAME == 'etree':
+    import xml.etree.ElementTree as ET
+
+@contextlib.contextmanager
+def no_gc():
+    # Building a tree allocates so many objects that the cyclic garbage
+    # collector runs over and over, each time scanning every tree still
+    # alive (such as those kept in a cache.MemoryScoreCache). Trees have no
+    # reference cycles, so there is nothing for it to find.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+if NAME == 'lxml':
+    # Drop comments and processing instructions like ElementTree does, and
+    # don't refuse very large scores.
+    _parser = ET.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+
+    # An lxml element has only one parent, so appending it to another
+    # element moves it there. Elements that must stay where they are need
+    # to be copied instead (see share).
+    MULTIPLE_PARENTS = False
+
+    def parse(source):
+        return ET.parse(source, _parser)
+
+    def fromstring(text):
+        if isinstance(text, str):
+            text = text.encode('UTF-8') # lxml rejects str with an encoding declaration
+        return ET.fromstring(text, _parser)
+
+    def path(expr):
+        # compiled XPath: returns a function that finds expr under an element
+        return ET.XPath(expr)
+
+    def share(element):
+        return copy.deepcopy(element)
+
+    deepcopy = copy.deepcopy
+
+    def _fix_empty_tags(data):
+        # ElementTree writes <tag /> and lxml writes <tag/>. "/>" can't occur
+        # anywhere else as ">" is escaped in text and attributes.
+        return data.replace(b'/>', b' />')
+
+    def tostring(element):
+        # UTF-8 bytes of element and its tail, without an XML declaration
+        return _fix_empty_tags(ET.tostring(element, encoding='UTF-8'))
+
+    def write(tree, file):
+        file.write(_fix_empty_tags(ET.tostring(tree, encoding='UTF-8', xml_declaration=True)))
+
+else:
+    # An ElementTree element can be appended to several parents and stays
+    # in all of them, so appending never disturbs the source score.
+    MULTIPLE_PARENTS = True
+
+    def parse(source):
+        with no_gc():
+            return ET.parse(source)
+
+    def fromstring(text):
+        with no_gc():
+            return ET.fromstring(text)
+
+    def deepcopy(element):
+        with no_gc():
+            return copy.deepcopy(element)
+
+    def path(expr):
+        return lambda element: element.findall(expr)
+
+    def share(element):
+        return element
+
+    def tostring(element):
+        return ET.tostring(element, encoding='unicode').encode('UTF-8')
+
+    def write(tree, file):
+        tree.write(file, encoding="UTF-8", xml_declaration="True")
@@ -0,0 +1,71 @@
+# Checks the structure of the filler that joins give parts and staves
+# missing from an appended score: test/Mvt2 is missing a staff of the voice
+# part, and test/PianoOnly is missing the whole voice part. Every staff of
+# the output must have the same number of measures, rests must be in a
+# voice (not straight under the staff or measure), and the filler measures
+# must hold only a measure rest as long as the measure.
+# Run with: python -m pytest test
+
+import fractions
+import os
+import subprocess
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+
+import score
+
+join = os.path.join(here, "..", "mscore-python", "mscore-join.py")
+movements = [os.path.join(here, name + ".mscx") for name in ["Mvt1", "Mvt2", "PianoOnly", "Mvt3"]]
+
+# staves (0-based) that each movement leaves to filler
+FILLED = {"Mvt2": [0], "PianoOnly": [0, 1]}
+
+CACHE = "cache directory"
+MODES = [[], ["--stream"], ["-j", "2"], ["--cache-dir", CACHE]]
+
+def run_join(args, backend, tmp_path):
+    if backend == "lxml":
+        pytest.importorskip("lxml")
+    args = [str(tmp_path / "cache") if arg == CACHE else arg for arg in args]
+    env = dict(os.environ, MSCORE_XML=backend)
+    env.pop("MSCORE_JOIN_SOCKET", None) # join here, not in a server
+    output = tmp_path / "join.mscx"
+    with open(output, "wb") as f:
+        subprocess.run([sys.executable, join] + args + movements, env=env,
+                       stdout=f, stderr=subprocess.DEVNULL, check=True)
+    return score.ScoreFile(str(output))
+
+def measure_rests(measure):
+    return [rest for rest in measure.iter('Rest') if rest.findtext('durationType') == 'measure']
+
+@pytest.mark.parametrize("backend", ["etree", "lxml"])
+@pytest.mark.parametrize("mode", MODES, ids=lambda m: m[0] if m else "tree")
+def test_filler_structure(mode, backend, tmp_path):
+    joined = run_join(mode + ["-p"], backend, tmp_path)
+    lengths = [len(score.ScoreFile(path).timeline) for path in movements]
+    for staff in joined.staves:
+        measures = staff.findall('Measure')
+        assert len(measures) == sum(lengths)
+        assert staff.findall('Rest') == [] and staff.findall('Measure/Rest') == []
+        # staves can have their own time signatures
+        timeline = score.MeasureTimeline(joined.division * 4)
+        for measure in measures:
+            timeline.add_measure(measure)
+        for idx, measure in enumerate(measures):
+            for rest in measure_rests(measure):
+                assert fractions.Fraction(rest.findtext('duration')) * timeline.ticksPerWhole == timeline.length(idx)
+
+    start = 0
+    for path, length in zip(movements, lengths):
+        name = os.path.splitext(os.path.basename(path))[0]
+        for staffIdx in FILLED.get(name, []):
+            staff = joined.staves[staffIdx]
+            for measure in staff.findall('Measure')[start:start + length]:
+                assert [voice.tag for voice in measure.findall('voice/*')
+                        if voice.tag not in ['TimeSig', 'KeySig', 'BarLine']] == ['Rest']
+                assert len(measure_rests(measure)) == 1
+        start += length
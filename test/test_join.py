@@ -0,0 +1,110 @@
+# Joins test/Mvt1 and test/Mvt3 with each combination of layout breaks and
+# checks that the output is byte-identical to what the original join gave
+# (test/golden, written before the running offsets and single-walk shifting
+# replaced the rescans of the first score). The streaming and parallel joins
+# must give the same bytes, as must joins from a cold and a warm score cache,
+# which append the cached scores as bytes. --raw copies the rest of the
+# input bytes as they are, so only its canonical XML must be the same, and
+# it must fall back to the tree join for scores with different parts. Each
+# test runs with both XML backends (lxml only if it is installed), and joins
+# with test/Mvt2 and test/PianoOnly, which are missing a staff and a part and
+# so get filler, must give the same bytes with both (see also
+# test_filler.py). Each --variant must be what joining with its options
+# gives, also when it needs a pass of its own.
+# Run with: python -m pytest test
+
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+join = os.path.join(here, "..", "mscore-python", "mscore-join.py")
+movements = [os.path.join(here, "Mvt1.mscx"), os.path.join(here, "Mvt3.mscx")]
+withFiller = [os.path.join(here, name + ".mscx") for name in ["Mvt1", "Mvt2", "PianoOnly", "Mvt3"]]
+
+BREAKS = [[], ["-l"], ["-p"], ["-s"], ["-l", "-s"], ["-p", "-s"]]
+MODES = [[], ["--stream"], ["-j", "2"]]
+BACKENDS = ["etree", "lxml"]
+
+def use_backend(backend):
+    if backend == "lxml":
+        pytest.importorskip("lxml")
+    return backend
+
+def golden(breaks):
+    with open(os.path.join(here, "golden", "join" + "".join(breaks) + ".mscx"), "rb") as f:
+        return f.read()
+
+def run(args, backend):
+    env = dict(os.environ, MSCORE_XML=backend)
+    env.pop("MSCORE_JOIN_SOCKET", None) # join here, not in a server
+    return subprocess.run([sys.executable, join] + args, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+def run_join(args, backend):
+    return run(args, backend).stdout
+
+def canonical(xml):
+    return ET.canonicalize(xml.decode(), strip_text=True)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("mode", MODES, ids=lambda m: " ".join(m) or "tree")
+@pytest.mark.parametrize("breaks", BREAKS, ids=lambda b: " ".join(b) or "no breaks")
+def test_join_matches_golden(breaks, mode, backend):
+    assert run_join(mode + breaks + movements, use_backend(backend)) == golden(breaks)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("mode", [[], ["-j", "2"]], ids=lambda m: " ".join(m) or "tree")
+@pytest.mark.parametrize("breaks", BREAKS, ids=lambda b: " ".join(b) or "no breaks")
+def test_cached_join_matches_golden(breaks, mode, backend, tmp_path):
+    args = ["--cache-dir", str(tmp_path)] + mode + breaks + movements
+    assert run_join(args, use_backend(backend)) == golden(breaks) # cold
+    assert run_join(args, backend) == golden(breaks) # warm
+
+@pytest.mark.parametrize("mode", MODES, ids=lambda m: " ".join(m) or "tree")
+@pytest.mark.parametrize("breaks", BREAKS, ids=lambda b: " ".join(b) or "no breaks")
+def test_backends_agree_with_filler(breaks, mode):
+    use_backend("lxml")
+    args = mode + breaks + withFiller
+    assert run_join(args, "lxml") == run_join(args, "etree")
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("breaks", BREAKS, ids=lambda b: " ".join(b) or "no breaks")
+def test_raw_join_matches_tree_join(breaks, backend):
+    result = run(["--raw"] + breaks + movements, use_backend(backend))
+    assert b"normal join" not in result.stderr # joined as raw bytes
+    assert canonical(result.stdout) == canonical(golden(breaks))
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_raw_join_falls_back_if_parts_differ(backend):
+    result = run(["--raw", "-p", "-s"] + withFiller, use_backend(backend))
+    assert b"Can't join as raw bytes" in result.stderr
+    assert result.stdout == run_join(["-p", "-s"] + withFiller, backend)
+
+def numbered(paths, directory):
+    # copies of the scores with measure numbers, which section breaks reset
+    copies = []
+    for path in paths:
+        tree = ET.parse(path)
+        for staff in tree.getroot().iter('Staff'):
+            for idx, measure in enumerate(staff.iter('Measure')):
+                measure.set('number', str(idx + 1))
+        copies.append(str(directory / os.path.basename(path)))
+        tree.write(copies[-1], encoding="UTF-8", xml_declaration=True)
+    return copies
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_variants_match_joins(backend, tmp_path):
+    # with measure numbers the variant with section breaks needs a pass of
+    # its own, which reloads the first score
+    files = numbered(withFiller, tmp_path)
+    variants = {"a.mscx": ["-p"], "b.mscx": ["-p", "-s"]}
+    args = ["--multimeasure-rests"]
+    for name, breaks in variants.items():
+        args += ["-V", " ".join([str(tmp_path / name)] + breaks)]
+    run(args + files, use_backend(backend))
+    for name, breaks in variants.items():
+        assert (tmp_path / name).read_bytes() == run_join(["--multimeasure-rests"] + breaks + files, backend)
@@ -0,0 +1,73 @@
+# Checks that --plan predicts the offsets that a join shifts each score by,
+# and the totals after the join, for generated scores with element IDs,
+# measure numbers and time signatures, a cover with IDs of its own, and with
+# and without section breaks. Also that it reports scores that can't be
+# joined and exits with status 1. Run with: python -m pytest test
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+join = os.path.join(here, "..", "mscore-python", "mscore-join.py")
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+sys.path.append(os.path.join(here, "..", "bench")) # last, so bench/cache.py doesn't hide cache
+
+import cli
+import generate
+import score
+
+def run_plan(args):
+    env = dict(os.environ)
+    env.pop("MSCORE_JOIN_SOCKET", None) # plan here, not in a server
+    return subprocess.run([sys.executable, join, "--plan"] + args, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+def write_scores(directory):
+    paths = []
+    for seed, measures in [(1, 12), (2, 10), (3, 7)]:
+        tree = generate.generate_score(parts=2, measures=measures, time_sigs=((6, 8), (3, 4)),
+                                       measures_per_time_sig=3, seed=seed)
+        for idx, measure in enumerate(tree.getroot().iter('Measure')):
+            measure.set('number', str(idx % measures + 1))
+        paths.append(str(directory / ("Mvt%d.mscx" % seed)))
+        generate.write_score(tree, paths[-1])
+    tree = generate.generate_score(parts=2, measures=0, title="Cover")
+    tree.getroot().find('.//VBox/Text').set('id', '5000') # more than any ID in the scores
+    cover = str(directory / "Cover.mscx")
+    generate.write_score(tree, cover)
+    return paths, cover
+
+@pytest.mark.parametrize("sections", [[], ["-s"]], ids=["no section breaks", "-s"])
+def test_plan_matches_join(sections, tmp_path):
+    paths, cover = write_scores(tmp_path)
+    result = run_plan(["-p", "-c", cover] + sections + paths)
+    assert result.returncode == 0
+    plan = json.loads(result.stdout)
+    assert plan["errors"] == []
+
+    # join as mscore-join.py does, noting the offsets of each score
+    addSectionBreak = bool(sections)
+    firstScore = score.ScoreFile(paths[0])
+    cli.add_covers(firstScore, [cover], {})
+    joined = score.ScoreJoin(firstScore)
+    offsets = [(0, 0, 0)]
+    for path in paths[1:]:
+        offsets.append((joined.maxElementID, 0 if addSectionBreak else joined.maxMeasureNumber, joined.ticks))
+        joined.append_score(score.ScoreFile(path), False, True, addSectionBreak)
+
+    assert offsets[1][0] == 5000 # the cover's IDs come first
+    assert [(s["offsets"]["id"], s["offsets"]["measure"], s["offsets"]["tick"]) for s in plan["scores"]] == offsets
+    assert plan["total"] == {"maxElementID": joined.maxElementID, "maxMeasureNumber": joined.maxMeasureNumber,
+                             "ticks": joined.ticks, "measures": len(joined.timeline)}
+
+def test_plan_reports_mismatch(tmp_path):
+    # the first score has fewer parts than the others
+    pianoOnly = os.path.join(here, "PianoOnly.mscx")
+    result = run_plan([pianoOnly, os.path.join(here, "Mvt1.mscx")])
+    assert result.returncode == 1
+    plan = json.loads(result.stdout)
+    assert any("more parts than the first score" in error for error in plan["errors"])
@@ -0,0 +1,60 @@
+# Checks MeasureTimeline lookups on a MuseScore 3 score, which has its time
+# signatures in the first voice of a measure, and that the total duration
+# the join shifts by is still counted as before (as if every measure
+# without a len were 4/4). Run with: python -m pytest test
+
+import fractions
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+
+import rawjoin
+import score
+
+def measure(timeSig=None, length=None):
+    timeSigXML = "<TimeSig><sigN>%d</sigN><sigD>%d</sigD></TimeSig>" % timeSig if timeSig else ""
+    lengthXML = ' len="%s"' % length if length else ""
+    return ("<Measure%s><voice>%s<Rest><durationType>measure</durationType></Rest></voice></Measure>"
+            % (lengthXML, timeSigXML))
+
+SCORE = ('<?xml version="1.0" encoding="UTF-8"?>\n<museScore version="3.01"><Score><Division>480</Division>'
+         '<Style/><Part><Staff id="1"/></Part><Staff id="1">'
+         + measure((3, 4), "1/4") + measure() + measure((6, 8)) + measure() + measure((2, 2)) +
+         '</Staff></Score></museScore>')
+
+def timelines(tmp_path):
+    path = tmp_path / "Timesigs.mscx"
+    path.write_text(SCORE)
+    return score.ScoreFile(str(path)).timeline, rawjoin.RawScore(str(path)).timeline
+
+def test_lookups(tmp_path):
+    for timeline in timelines(tmp_path):
+        assert len(timeline) == 5
+        assert [timeline.time_sig(idx) for idx in range(5)] == [fractions.Fraction(3, 4), fractions.Fraction(3, 4),
+                                                                 fractions.Fraction(6, 8), fractions.Fraction(6, 8),
+                                                                 fractions.Fraction(2, 2)]
+        assert [timeline.tick(idx) for idx in range(5)] == [0, 480, 1920, 3360, 4800]
+        assert [timeline.length(idx) for idx in range(5)] == [480, 1440, 1440, 1440, 1920]
+        assert timeline.measure_at(0) == 0
+        assert timeline.measure_at(479) == 0
+        assert timeline.measure_at(480) == 1
+        assert timeline.measure_at(4799) == 3
+        assert timeline.measure_at(6719) == 4
+        assert timeline.measure_at(6720) is None
+        assert timeline.measure_at(-1) is None
+        assert timeline.ticks == 480 + 4 * 1920 # as the join has always counted it
+
+def test_extend_and_truncate(tmp_path):
+    timeline, other = timelines(tmp_path)
+    timeline.extend(other)
+    assert len(timeline) == 10
+    assert timeline.tick(5) == 6720
+    assert timeline.time_sig(5) == fractions.Fraction(3, 4)
+    assert timeline.measure_at(6720 + 480) == 6
+    assert timeline.ticks == 2 * (480 + 4 * 1920)
+    timeline.truncate(5)
+    assert len(timeline) == 5
+    assert timeline.measure_at(6720) is None
+    assert timeline.ticks == 480 + 4 * 1920
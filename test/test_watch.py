@@ -0,0 +1,76 @@
+# Checks that rebuilding a recipe with RecipeWatcher, which undoes the
+# IncrementalScoreJoin back to the first changed movement and appends from
+# there, gives the same output as joining the recipe from scratch, after an
+# edit that leaves the offsets of later movements as they were and one that
+# changes them. Uses the XML backend that mscore-join.py would.
+# Run with: python -m pytest test
+
+import io
+import os
+import shutil
+import sys
+
+import pytest
+import yaml
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "mscore-python"))
+
+import cache
+import recipe
+import watch
+
+EXTRA_MEASURE = """
+      <Measure>
+        <voice>
+          <Rest>
+            <durationType>measure</durationType>
+            <duration>4/4</duration>
+            </Rest>
+          </voice>
+        </Measure>"""
+
+def output(join):
+    f = io.BytesIO()
+    join.writeToFile(f)
+    return f.getvalue()
+
+def edit(path, text):
+    # replace the file, making sure its signature changes
+    st = os.stat(path)
+    with open(path, "w") as f:
+        f.write(text)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+@pytest.mark.parametrize("scoreCache", [None, "memory"])
+def test_rebuild_after_edit_matches_fresh_join(scoreCache, tmp_path):
+    names = ["Mvt1", "Mvt3", "Middle", "PianoOnly", "Mvt3"]
+    shutil.copy(os.path.join(here, "Mvt1.mscx"), tmp_path / "Mvt1.mscx")
+    shutil.copy(os.path.join(here, "Mvt2.mscx"), tmp_path / "Middle.mscx")
+    shutil.copy(os.path.join(here, "Mvt3.mscx"), tmp_path / "Mvt3.mscx")
+    shutil.copy(os.path.join(here, "PianoOnly.mscx"), tmp_path / "PianoOnly.mscx")
+    recipeFile = tmp_path / "recipe.yml"
+    structure = {'structure': [{'score': str(tmp_path / name)} for name in names]}
+    recipeFile.write_text(yaml.safe_dump(structure))
+    middle = tmp_path / "Middle.mscx"
+
+    watcher = watch.RecipeWatcher(str(recipeFile), cache.MemoryScoreCache() if scoreCache else None)
+    def fresh():
+        return output(recipe.Recipe(structure).join())
+
+    assert watcher.build() == 4
+    assert output(watcher.join) == fresh()
+
+    # same length and IDs, so the movements after it keep their offsets
+    edit(middle, middle.read_text().replace("<pitch>", "<pitch>1", 1))
+    assert watcher.build() == 3
+    assert output(watcher.join) == fresh()
+
+    # a measure longer, which shifts the movements after it
+    ticks = watcher.join.ticks
+    edit(middle, middle.read_text().replace("\n      </Staff>", EXTRA_MEASURE + "\n      </Staff>"))
+    assert watcher.build() == 3
+    assert watcher.join.ticks == ticks + 1920
+    assert output(watcher.join) == fresh()
+
+    assert watcher.build() is None # nothing changed